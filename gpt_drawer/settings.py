@@ -46,6 +46,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
     'rest_framework',
     'django_filters',
@@ -102,6 +103,19 @@ DATABASES = {
     'default': env.db('DATABASE_URL'),
 }
 
+# shared by the web and worker processes, holds only what can be recomputed, like query embeddings,
+# task keys and counters have tables of their own (`TaskLease` and `Counter`)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'django_cache',
+        'OPTIONS': {
+            # every write counts the entries, a third of them is culled above this
+            'MAX_ENTRIES': env.int('CACHE_MAX_ENTRIES', default=10_000),
+        },
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -162,10 +176,83 @@ REST_FRAMEWORK = {
 
 # openai
 OPENAI_API_KEY = env.str('OPENAI_API_KEY', default='')
+# requests a single task keeps in flight
+OPENAI_CONCURRENCY = env.int('OPENAI_CONCURRENCY', default=16)
+# limits shared by all processes, per model, set them a bit under the account quota, 0 disables the limit
+OPENAI_REQUESTS_PER_MINUTE = env.int('OPENAI_REQUESTS_PER_MINUTE', default=3_000)
+OPENAI_TOKENS_PER_MINUTE = env.int('OPENAI_TOKENS_PER_MINUTE', default=250_000)
+# part of the limits kept for interactive requests, like search queries, so bulk work can't hold them up
+OPENAI_INTERACTIVE_SHARE = env.float('OPENAI_INTERACTIVE_SHARE', default=0.1)
+# times a request rejected for exceeding the limits is sent
+OPENAI_RATE_LIMIT_ATTEMPTS = env.int('OPENAI_RATE_LIMIT_ATTEMPTS', default=3)
+
+# embedding model for notes and search queries: 'openai' or 'hashing' (local, for offline tests and benchmarks)
+EMBEDDING_BACKEND = env.str('EMBEDDING_BACKEND', default='openai')
+# embedding model being migrated to, notes are embedded with both models until search switches to it
+EMBEDDING_NEXT_BACKEND = env.str('EMBEDDING_NEXT_BACKEND', default='')
+# notes embedded by every run of the backfill task, it runs every minute
+EMBEDDING_BACKFILL_BATCH_SIZE = env.int('EMBEDDING_BACKFILL_BATCH_SIZE', default=200)
+# notes whose embeddings are recomputed from stored chunks at once, it takes no model calls
+EMBEDDING_RECOMPUTE_BATCH_SIZE = env.int('EMBEDDING_RECOMPUTE_BATCH_SIZE', default=1000)
+# seconds search keeps using the current model after the backfill completes
+EMBEDDING_BACKFILL_CHECK_INTERVAL = env.int('EMBEDDING_BACKFILL_CHECK_INTERVAL', default=60)
+
+# pgvector
+# size of the candidate list in HNSW index scans, higher means better recall but slower search
+EMBEDDING_SEARCH_EF_SEARCH = env.int('EMBEDDING_SEARCH_EF_SEARCH', default=100)
+# keep scanning the index when filters (notebook, state) discard too many candidates
+EMBEDDING_SEARCH_ITERATIVE_SCAN = env.str('EMBEDDING_SEARCH_ITERATIVE_SCAN', default='strict_order')
+# semantic search first collects this many candidates using short embeddings and then reranks them
+# using full embeddings, 0 searches full embeddings directly
+EMBEDDING_SEARCH_RERANK_CANDIDATES = env.int('EMBEDDING_SEARCH_RERANK_CANDIDATES', default=200)
+# how candidates are collected: 'binary' (hamming distance of sign bits) or 'short' (short embeddings)
+EMBEDDING_SEARCH_PREFILTER = env.str('EMBEDDING_SEARCH_PREFILTER', default='binary')
+# 'postgres' uses the indexes above, 'numpy' scans per notebook memory mapped files in EMBEDDING_INDEX_DIR
+EMBEDDING_SEARCH_BACKEND = env.str('EMBEDDING_SEARCH_BACKEND', default='postgres')
+EMBEDDING_INDEX_DIR = env.str('EMBEDDING_INDEX_DIR', default=str(BASE_DIR / 'embedding_index'))
+# cosine distance of the best chunk above which hybrid search ignores the semantic match
+HYBRID_SEARCH_MAX_DISTANCE = env.float('HYBRID_SEARCH_MAX_DISTANCE', default=0.7)
+# number of nearest notes kept for every note in the neighbour table
+NOTE_NEIGHBOURS_COUNT = env.int('NOTE_NEIGHBOURS_COUNT', default=10)
+# notes closer than this cosine distance are considered duplicates
+NOTE_DUPLICATE_DISTANCE = env.float('NOTE_DUPLICATE_DISTANCE', default=0.1)
+
+# embedding cache, least recently used entries are evicted above this size
+EMBEDDING_CACHE_MAX_ENTRIES = env.int('EMBEDDING_CACHE_MAX_ENTRIES', default=100_000)
+
+# search query embeddings, cached in process and in the shared django cache
+QUERY_EMBEDDING_CACHE_MAX_ENTRIES = env.int('QUERY_EMBEDDING_CACHE_MAX_ENTRIES', default=1024)
+QUERY_EMBEDDING_CACHE_TTL = env.int('QUERY_EMBEDDING_CACHE_TTL', default=24 * 60 * 60)
+
+# chat completion cache, entries expire after the TTL (seconds) and least recently used ones are evicted above the size
+COMPLETION_CACHE_MAX_ENTRIES = env.int('COMPLETION_CACHE_MAX_ENTRIES', default=10_000)
+COMPLETION_CACHE_TTL = env.int('COMPLETION_CACHE_TTL', default=30 * 24 * 60 * 60)
+
+# embedding batches
+# seconds to wait for more notes to arrive before embedding a batch
+EMBEDDING_BATCH_WINDOW = env.float('EMBEDDING_BATCH_WINDOW', default=1.0)
+EMBEDDING_BATCH_SIZE = env.int('EMBEDDING_BATCH_SIZE', default=128)
+EMBEDDING_BATCH_MAX_TOKENS = env.int('EMBEDDING_BATCH_MAX_TOKENS', default=100_000)
+# seconds notes of a batch stay claimed by its task, notes of a killed task are embedded again after that
+EMBEDDING_CLAIM_TIMEOUT = env.int('EMBEDDING_CLAIM_TIMEOUT', default=5 * 60)
+
+# note titles, seconds to wait for more untitled notes and notes titled by one LLM call
+NOTE_TITLE_BATCH_WINDOW = env.float('NOTE_TITLE_BATCH_WINDOW', default=1.0)
+NOTE_TITLE_BATCH_SIZE = env.int('NOTE_TITLE_BATCH_SIZE', default=10)
+# seconds notes of a batch stay claimed by its task, notes the model failed to title are tried again after that
+NOTE_TITLE_CLAIM_TIMEOUT = env.int('NOTE_TITLE_CLAIM_TIMEOUT', default=5 * 60)
+
+# long notes are embedded in chunks of about this many tokens, consecutive chunks overlap
+NOTE_CHUNK_TOKENS = env.int('NOTE_CHUNK_TOKENS', default=512)
+NOTE_CHUNK_OVERLAP_TOKENS = env.int('NOTE_CHUNK_OVERLAP_TOKENS', default=64)
 
 # Django Q
+# seconds an idempotency key of a task outlives the task if it is killed, should cover the broker retry
+TASK_KEY_TIMEOUT = env.int('TASK_KEY_TIMEOUT', default=10 * 60)
 Q_CLUSTER = {
     'orm': 'default',
+    # the `orm` broker table, claimed with SKIP LOCKED and woken up by NOTIFY
+    'broker_class': 'notes.task_broker.PostgresBroker',
 
     # task is killed when no result in set time
     'timeout': 60,
@@ -173,7 +260,23 @@ Q_CLUSTER = {
     'retry': 120,
     'workers': env.int('DJANGO_Q_WORKERS', default=2),
     'catch_up': False,
+    # clusters of priority lanes, see `notes.task_queues`
+    'ALT_CLUSTERS': {
+        'interactive': {
+            'workers': env.int('DJANGO_Q_INTERACTIVE_WORKERS', default=1),
+        },
+        'normal': {
+            'workers': env.int('DJANGO_Q_NORMAL_WORKERS', default=2),
+        },
+        'bulk': {
+            'workers': env.int('DJANGO_Q_BULK_WORKERS', default=1),
+            'timeout': 5 * 60,
+            'retry': 10 * 60,
+        },
+    },
 }
+# lanes with their own cluster running, tasks of other lanes run in the default cluster
+TASK_LANES = env.list('TASK_LANES', default=[])
 
 # django debug toolbar
 DEBUG_TOOLBAR_ENABLED = DEBUG
@@ -2,10 +2,19 @@ from urllib.parse import urlparse
 
 from django.contrib import admin
 from django.urls import resolve
+from django.utils.translation import gettext as _
+from django_q.admin import QueueAdmin
+from django_q.models import OrmQ
 
 from admin_utils import get_autocomplete_object_id
 
-from .models import Alias, Note, Notebook, NotebookUserPermission, Reference
+from .embedding_backends import get_backfill_progress, get_embedding_backend, get_next_embedding_backend
+from .models import (
+    Alias, CompletionCacheEntry, EmbeddingCacheEntry, Note, Notebook, NotebookUserPermission, NoteChunk,
+    RateLimitBucket, Reference,
+)
+from .openai import get_embedding_cache_stats, query_embedding_cache
+from .task_queues import get_queue_wait_stats
 
 
 class NotebookUserPermissionInline(admin.TabularInline):
@@ -61,3 +70,92 @@ class NoteAdmin(admin.ModelAdmin):
             initial['notebook'] = note.notebook_id
 
         return initial
+
+
+@admin.register(EmbeddingCacheEntry)
+class EmbeddingCacheEntryAdmin(admin.ModelAdmin):
+    list_display = ('text_hash', 'model', 'dimensions', 'hits', 'last_used_at')
+    list_filter = ('model', 'dimensions')
+    search_fields = ('text_hash',)
+    fields = ('text_hash', 'model', 'dimensions', 'hits', 'created_at', 'last_used_at')
+    readonly_fields = fields
+
+    def changelist_view(self, request, extra_context=None):
+        stats = get_embedding_cache_stats()
+        query_hit_rate = query_embedding_cache.get_stats()['hit_rate']
+        extra_context = {
+            'title': _(
+                'Embedding cache (hits: %(hits)d, misses: %(misses)d, query cache hit rate: %(query_hit_rate)s)'
+            ) % {
+                **stats,
+                'query_hit_rate': '-' if query_hit_rate is None else f'{query_hit_rate:.0%}',
+            },
+            **(extra_context or {}),
+        }
+        return super().changelist_view(request, extra_context=extra_context)
+
+
+@admin.register(NoteChunk)
+class NoteChunkAdmin(admin.ModelAdmin):
+    list_display = ('note', 'position', 'embedding_model', 'embedding_dimensions')
+    list_filter = ('embedding_model', 'embedding_dimensions')
+    search_fields = ('note__title', 'note__id')
+    fields = ('note', 'position', 'content', 'embedding_model', 'embedding_dimensions')
+    readonly_fields = fields
+
+    def changelist_view(self, request, extra_context=None):
+        progress = []
+        for backend in filter(None, (get_embedding_backend(), get_next_embedding_backend())):
+            stats = get_backfill_progress(backend)
+            progress.append(_(
+                '%(model)s: %(done)d/%(total)d notes, %(percent)s, %(throughput)s notes/s'
+            ) % {
+                **stats,
+                'model': backend.model,
+                'percent': f'{stats["done"] / stats["total"]:.0%}' if stats['total'] else '-',
+                'throughput': '-' if stats['throughput'] is None else f'{stats["throughput"]:.1f}',
+            })
+        extra_context = {
+            'title': _('Note chunks (%(progress)s)') % {'progress': '; '.join(progress)},
+            **(extra_context or {}),
+        }
+        return super().changelist_view(request, extra_context=extra_context)
+
+
+@admin.register(CompletionCacheEntry)
+class CompletionCacheEntryAdmin(admin.ModelAdmin):
+    list_display = ('request_hash', 'model', 'hits', 'created_at', 'last_used_at')
+    list_filter = ('model',)
+    search_fields = ('request_hash',)
+    fields = ('request_hash', 'model', 'response', 'hits', 'created_at', 'last_used_at')
+    readonly_fields = fields
+
+
+@admin.register(RateLimitBucket)
+class RateLimitBucketAdmin(admin.ModelAdmin):
+    list_display = ('name', 'tokens', 'updated_at', 'paused_until')
+    search_fields = ('name',)
+
+
+class TaskQueueAdmin(QueueAdmin):
+    def changelist_view(self, request, extra_context=None):
+        waits = [
+            _('%(queue)s: %(tasks)d tasks, average wait %(average_wait)s, last wait %(last_wait)s') % {
+                **stats,
+                'queue': queue,
+                'average_wait': '-' if stats['average_wait'] is None else f'{stats["average_wait"]:.1f}s',
+                'last_wait': '-' if stats['last_wait'] is None else f'{stats["last_wait"]:.1f}s',
+            }
+            for queue, stats in get_queue_wait_stats().items()
+        ]
+        extra_context = {
+            'title': _('Queued tasks (%(waits)s)') % {'waits': '; '.join(waits)},
+            **(extra_context or {}),
+        }
+        return super().changelist_view(request, extra_context=extra_context)
+
+
+# django-q registers its queue admin only with the ORM broker
+if admin.site.is_registered(OrmQ):
+    admin.site.unregister(OrmQ)
+    admin.site.register(OrmQ, TaskQueueAdmin)
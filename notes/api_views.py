@@ -34,7 +34,7 @@ class NoteFiterSet(django_filters.FilterSet):
         fields = ()
 
     def search_filter(self, queryset, name, value):
-        return queryset.autocomplete_search(value)
+        return queryset.hybrid_search(value)
 
 
 class NoteViewSet(ModelViewSet):
@@ -45,11 +45,6 @@ class NoteViewSet(ModelViewSet):
     def get_queryset(self):
         return self.queryset.accessible_by_user(self.request.user)
 
-    def filter_queryset(self, queryset):
-        queryset = super().filter_queryset(queryset)
-        queryset = queryset.distinct()
-        return queryset
-
 
 class InNoteViewSetMixin:
     def dispatch(self, request, *args, note_pk, **kwargs):
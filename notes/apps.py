@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class NotesConfig(AppConfig):
     name = 'notes'
+
+    def ready(self):
+        from django_q.signals import pre_execute
+
+        from .task_queues import record_queue_wait
+        pre_execute.connect(record_queue_wait, dispatch_uid='notes.record_queue_wait')
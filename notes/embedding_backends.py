@@ -0,0 +1,171 @@
+"""
+Embedding models, `settings.EMBEDDING_BACKEND` selects the one used for notes and search queries.
+
+Embeddings of different models are not comparable, so the model is stored together with every embedding.
+To switch models without downtime set `settings.EMBEDDING_NEXT_BACKEND`. Notes are then embedded
+with both models and `backfill_note_embeddings` task embeds the existing notes with the next one.
+Search switches to the next model once all notes have it. After that it can become `EMBEDDING_BACKEND`,
+note embeddings are then recomputed from already stored chunks without calling the model,
+all of them in the first backfill run. Until then searches by note embedding skip notes not recomputed yet.
+"""
+import functools
+import hashlib
+import math
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy
+from django.conf import settings
+from django.core.cache import cache
+
+from .openai import (
+    EMBEDDING_DIMENSIONS, estimate_tokens, get_async_openai_client, run_rate_limited, split_into_batches,
+)
+
+
+class EmbeddingBackend:
+    model = None
+    dimensions = None
+
+    def embed(self, texts, interactive=False):
+        """
+        Embeddings of the texts, in the same order.
+        `interactive` is for requests someone waits for, see `rate_limit` module.
+        """
+        raise NotImplementedError
+
+
+class OpenAIEmbeddingBackend(EmbeddingBackend):
+    model = 'text-embedding-3-large'
+    dimensions = EMBEDDING_DIMENSIONS
+
+    def embed(self, texts, interactive=False):
+        client = get_async_openai_client()
+        responses = run_rate_limited([
+            (
+                self.model,
+                sum(estimate_tokens(text) for text in batch),
+                functools.partial(client.embeddings.create, input=batch, model=self.model),
+            )
+            for batch in split_into_batches(texts)
+        ], interactive)
+        return [
+            item.embedding
+            for response in responses
+            for item in sorted(response.data, key=lambda item: item.index)
+        ]
+
+
+class HashingEmbeddingBackend(EmbeddingBackend):
+    """
+    Signed feature hashing of words and their character trigrams, computed locally.
+
+    It knows nothing about meaning, texts are close when they share words or word parts.
+    Good enough to exercise search and vector indexes offline, in tests and benchmarks.
+    """
+    model = 'hashing'
+    dimensions = EMBEDDING_DIMENSIONS
+
+    def embed(self, texts, interactive=False):
+        return [self.embed_text(text).tolist() for text in texts]
+
+    def embed_text(self, text):
+        words = re.findall(r'\w+', text.lower())
+        features = Counter(words)
+        features.update(
+            f'#{word[i:i + 3]}'
+            for word in words
+            for i in range(max(len(word) - 2, 1))
+        )
+        embedding = numpy.zeros(self.dimensions, dtype=numpy.float32)
+        for feature, count in features.items():
+            value = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'little')
+            sign = 1 if value & 1 else -1
+            embedding[(value >> 1) % self.dimensions] += sign * (1 + math.log(count))
+        norm = numpy.linalg.norm(embedding)
+        if not norm:
+            # texts without words still need a valid direction for cosine distance
+            embedding[0] = norm = 1
+        return embedding / norm
+
+
+EMBEDDING_BACKENDS = {
+    'openai': OpenAIEmbeddingBackend,
+    'hashing': HashingEmbeddingBackend,
+}
+
+
+def get_embedding_backend():
+    return EMBEDDING_BACKENDS[settings.EMBEDDING_BACKEND]()
+
+
+def get_next_embedding_backend():
+    if not settings.EMBEDDING_NEXT_BACKEND:
+        return None
+    return EMBEDDING_BACKENDS[settings.EMBEDDING_NEXT_BACKEND]()
+
+
+def get_search_embedding_backend():
+    """
+    Backend for search queries, the next one as soon as all notes are embedded with it.
+    """
+    next_backend = get_next_embedding_backend()
+    if next_backend is not None and is_backfill_complete(next_backend):
+        return next_backend
+    return get_embedding_backend()
+
+
+def get_backfill_cache_key(backend):
+    return f'notes:embedding-backfill:{backend.model}:{backend.dimensions}'
+
+
+def is_backfill_complete(backend):
+    """
+    Whether every note embedded by the current backend has chunks of the backend too.
+    Notes not embedded yet don't count, new notes get chunks of both backends.
+    """
+    from .models import Note
+
+    def check():
+        return not Note.objects.embedded_with(get_embedding_backend()).not_embedded_with(backend).exists()
+
+    # checked before every search, the answer may lag a little behind the backfill
+    return cache.get_or_set(
+        f'{get_backfill_cache_key(backend)}:complete',
+        check,
+        timeout=settings.EMBEDDING_BACKFILL_CHECK_INTERVAL,
+    )
+
+
+@contextmanager
+def record_backfill_throughput(backend, note_count):
+    """
+    Remember how many notes per second the last backfill batch embedded.
+    """
+    from .models import Counter
+
+    start = time.monotonic()
+    yield
+    duration = time.monotonic() - start
+    Counter.objects.assign({f'{get_backfill_cache_key(backend)}:throughput': note_count / max(duration, 1e-6)})
+
+
+def get_backfill_progress(backend):
+    """
+    Notes embedded by the backend, notes to embed and last measured throughput in notes per second.
+    """
+    from .models import BLANK_CONTENT_CONDITION, Counter, Note
+
+    notes = Note.objects.exclude(BLANK_CONTENT_CONDITION)
+    if backend.model == get_embedding_backend().model:
+        done = notes.embedded_with(backend).count()
+    else:
+        done = notes.count() - notes.not_embedded_with(backend).count()
+    throughput_key = f'{get_backfill_cache_key(backend)}:throughput'
+    return {
+        'done': done,
+        'total': notes.count(),
+        'throughput': Counter.objects.get_values([throughput_key]).get(throughput_key),
+    }
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:44
+
+import pgvector.django
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0008_remove_reference_embedding_remove_reference_question_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='embedding_half',
+            field=pgvector.django.HalfVectorField(
+                blank=True, dimensions=3072, editable=False, null=True,
+                verbose_name='embedding (half precision)',
+            ),
+        ),
+        migrations.RunSQL(
+            sql='UPDATE notes_note SET embedding_half = embedding::halfvec(3072) WHERE embedding IS NOT NULL',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=pgvector.django.HnswIndex(
+                ef_construction=64, fields=['embedding_half'], m=16,
+                name='note_embedding_half_hnsw', opclasses=('halfvec_cosine_ops',),
+            ),
+        ),
+    ]
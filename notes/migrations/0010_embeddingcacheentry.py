@@ -0,0 +1,59 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:47
+
+import uuid
+
+import django.utils.timezone
+import pgvector.django
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0009_note_embedding_half'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmbeddingCacheEntry',
+            fields=[
+                (
+                    'id',
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='identifier',
+                    ),
+                ),
+                (
+                    'text_hash',
+                    models.CharField(
+                        help_text='SHA-256 of the normalized text.',
+                        max_length=64,
+                        verbose_name='text hash',
+                    ),
+                ),
+                ('model', models.CharField(max_length=64, verbose_name='model')),
+                ('dimensions', models.PositiveIntegerField(verbose_name='dimensions')),
+                ('embedding', pgvector.django.VectorField(verbose_name='embedding')),
+                ('hits', models.PositiveIntegerField(default=0, verbose_name='hits')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                (
+                    'last_used_at',
+                    models.DateTimeField(
+                        db_index=True,
+                        default=django.utils.timezone.now,
+                        verbose_name='last used at',
+                    ),
+                ),
+            ],
+            options={
+                'verbose_name': 'embedding cache entry',
+                'verbose_name_plural': 'embedding cache entries',
+                'ordering': ('-last_used_at',),
+                'unique_together': {('text_hash', 'model', 'dimensions')},
+            },
+        ),
+    ]
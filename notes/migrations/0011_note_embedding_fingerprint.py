@@ -0,0 +1,39 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:49
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0010_embeddingcacheentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='embedding_fingerprint',
+            field=models.CharField(
+                blank=True, editable=False, max_length=32, verbose_name='embedding fingerprint',
+                help_text='Fingerprint of the content the embedding was generated from.',
+            ),
+        ),
+        # we don't know what existing embeddings were generated from, assume they are up to date
+        migrations.RunSQL(
+            sql='UPDATE notes_note SET embedding_fingerprint = md5(content) WHERE embedding IS NOT NULL',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(
+                condition=models.Q(
+                    ('embedding__isnull', True),
+                    models.Q(('embedding_fingerprint', django.db.models.functions.text.MD5('content')), _negated=True),
+                    _connector='OR',
+                ),
+                fields=['id'],
+                name='note_stale_embedding',
+            ),
+        ),
+    ]
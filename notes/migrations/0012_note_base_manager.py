@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:50
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0011_note_embedding_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='note',
+            options={
+                'base_manager_name': 'objects',
+                'ordering': ('notebook', 'title', 'id'),
+                'verbose_name': 'note',
+                'verbose_name_plural': 'notes',
+            },
+        ),
+    ]
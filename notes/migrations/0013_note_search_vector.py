@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:52
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0012_note_base_manager'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(
+                editable=False, null=True, verbose_name='search vector',
+            ),
+        ),
+        migrations.RunSQL(
+            sql='''
+                UPDATE notes_note SET search_vector =
+                    setweight(to_tsvector('simple', title), 'A') ||
+                    setweight(to_tsvector('simple', coalesce(
+                        (SELECT string_agg(title, ' ') FROM notes_alias WHERE note_id = notes_note.id),
+                        ''
+                    )), 'A') ||
+                    setweight(to_tsvector('simple', content), 'B')
+            ''',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='note_search_vector'),
+        ),
+    ]
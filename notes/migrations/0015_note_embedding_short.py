@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:59
+
+import pgvector.django
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0014_title_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='embedding_short',
+            field=pgvector.django.VectorField(
+                blank=True, dimensions=256, editable=False, null=True,
+                verbose_name='embedding (short)',
+            ),
+        ),
+        migrations.RunSQL(
+            sql=(
+                'UPDATE notes_note SET embedding_short = l2_normalize(subvector(embedding, 1, 256)) '
+                'WHERE embedding IS NOT NULL'
+            ),
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=pgvector.django.HnswIndex(
+                ef_construction=64, fields=['embedding_short'], m=16,
+                name='note_embedding_short_hnsw', opclasses=('vector_cosine_ops',),
+            ),
+        ),
+    ]
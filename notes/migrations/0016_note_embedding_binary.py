@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:06
+
+import pgvector.django
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0015_note_embedding_short'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='embedding_binary',
+            field=pgvector.django.BitField(
+                blank=True, editable=False, length=3072, null=True,
+                verbose_name='embedding (binary)',
+            ),
+        ),
+        migrations.RunSQL(
+            sql='UPDATE notes_note SET embedding_binary = binary_quantize(embedding) WHERE embedding IS NOT NULL',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=pgvector.django.HnswIndex(
+                ef_construction=64, fields=['embedding_binary'], m=16,
+                name='note_embedding_binary_hnsw', opclasses=('bit_hamming_ops',),
+            ),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:03
+
+import uuid
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0016_note_embedding_binary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NoteNeighbour',
+            fields=[
+                (
+                    'id',
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='identifier',
+                    ),
+                ),
+                ('distance', models.FloatField(verbose_name='distance')),
+                (
+                    'neighbour',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='neighbour_of',
+                        to='notes.note',
+                        verbose_name='neighbour',
+                    ),
+                ),
+                (
+                    'note',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='neighbours',
+                        to='notes.note',
+                        verbose_name='note',
+                    ),
+                ),
+            ],
+            options={
+                'verbose_name': 'note neighbour',
+                'verbose_name_plural': 'note neighbours',
+                'ordering': ('note', 'distance'),
+                'indexes': [models.Index(fields=['note', 'distance'], name='note_neighbour_distance')],
+                'unique_together': {('note', 'neighbour')},
+            },
+        ),
+    ]
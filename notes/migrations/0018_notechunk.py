@@ -0,0 +1,92 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:07
+
+import re
+import uuid
+
+import django.db.models.deletion
+import pgvector.django
+from django.conf import settings
+from django.db import migrations, models
+
+
+def get_single_chunk(content):
+    """
+    Content of the only chunk `split_into_chunks` makes of the content at the time of this migration,
+    None if it makes none or more than one.
+    """
+    words = re.findall(r'\S+\s*', content)
+    # tokens estimated as `len(text) // 3 + 1`, like `estimate_tokens` at the time of this migration
+    if not words or (len(words) > 1 and sum(len(word) // 3 + 1 for word in words) > settings.NOTE_CHUNK_TOKENS):
+        return None
+    return ''.join(words).strip()
+
+
+def create_single_chunks(apps, schema_editor):
+    """
+    A note that fits in one chunk gets it with the note embedding, longer notes are embedded again chunk by chunk.
+    """
+    Note = apps.get_model('notes', 'Note')
+    NoteChunk = apps.get_model('notes', 'NoteChunk')
+    chunks = []
+    long_note_ids = []
+    notes = Note.objects.filter(embedding__isnull=False).values_list('id', 'content', 'embedding')
+    for note_id, content, embedding in notes.iterator(chunk_size=1000):
+        chunk_content = get_single_chunk(content)
+        if chunk_content is not None:
+            chunks.append(NoteChunk(note_id=note_id, position=0, content=chunk_content, embedding=embedding))
+        elif content.strip():
+            long_note_ids.append(note_id)
+        if len(chunks) >= 1000:
+            NoteChunk.objects.bulk_create(chunks)
+            chunks = []
+    NoteChunk.objects.bulk_create(chunks)
+    Note.objects.filter(id__in=long_note_ids).update(embedding_fingerprint='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0017_noteneighbour'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NoteChunk',
+            fields=[
+                (
+                    'id',
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='identifier',
+                    ),
+                ),
+                ('position', models.PositiveIntegerField(verbose_name='position')),
+                ('content', models.TextField(verbose_name='content')),
+                ('embedding', pgvector.django.HalfVectorField(dimensions=3072, verbose_name='embedding')),
+                (
+                    'note',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='chunks',
+                        to='notes.note',
+                        verbose_name='note',
+                    ),
+                ),
+            ],
+            options={
+                'verbose_name': 'note chunk',
+                'verbose_name_plural': 'note chunks',
+                'ordering': ('note', 'position'),
+                'indexes': [
+                    pgvector.django.HnswIndex(
+                        ef_construction=64, fields=['embedding'], m=16,
+                        name='note_chunk_embedding_hnsw', opclasses=('halfvec_cosine_ops',),
+                    ),
+                ],
+            },
+        ),
+        migrations.RunPython(create_single_chunks, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0018_notechunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='embedding_dimensions',
+            field=models.PositiveIntegerField(editable=False, null=True, verbose_name='embedding dimensions'),
+        ),
+        migrations.AddField(
+            model_name='note',
+            name='embedding_model',
+            field=models.CharField(blank=True, editable=False, max_length=64, verbose_name='embedding model'),
+        ),
+        migrations.AddField(
+            model_name='notechunk',
+            name='embedding_dimensions',
+            field=models.PositiveIntegerField(null=True, verbose_name='embedding dimensions'),
+        ),
+        migrations.AddField(
+            model_name='notechunk',
+            name='embedding_model',
+            field=models.CharField(blank=True, max_length=64, verbose_name='embedding model'),
+        ),
+        # everything was embedded with text-embedding-3-large so far
+        migrations.RunSQL(
+            sql=[
+                "UPDATE notes_note SET embedding_model = 'text-embedding-3-large', embedding_dimensions = 3072 "
+                "WHERE embedding IS NOT NULL",
+                "UPDATE notes_notechunk SET embedding_model = 'text-embedding-3-large', embedding_dimensions = 3072",
+            ],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations
+
+
+BACKFILL_TASK = 'notes.tasks.backfill_note_embeddings'
+
+
+def create_schedule(apps, schema_editor):
+    Schedule = apps.get_model('django_q', 'Schedule')
+    Schedule.objects.update_or_create(
+        func=BACKFILL_TASK,
+        defaults={
+            'name': 'backfill note embeddings',
+            'schedule_type': 'I',
+            'minutes': 1,
+            'repeats': -1,
+        },
+    )
+
+
+def delete_schedule(apps, schema_editor):
+    Schedule = apps.get_model('django_q', 'Schedule')
+    Schedule.objects.filter(func=BACKFILL_TASK).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_q', '0017_task_cluster_alter'),
+        ('notes', '0019_embedding_model'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_schedule, delete_schedule),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:16
+
+import uuid
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0020_backfill_note_embeddings_schedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompletionCacheEntry',
+            fields=[
+                (
+                    'id',
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='identifier',
+                    ),
+                ),
+                (
+                    'request_hash',
+                    models.CharField(
+                        help_text='SHA-256 of the model, messages, response format and max tokens.',
+                        max_length=64,
+                        unique=True,
+                        verbose_name='request hash',
+                    ),
+                ),
+                ('model', models.CharField(max_length=64, verbose_name='model')),
+                ('response', models.JSONField(verbose_name='response')),
+                ('hits', models.PositiveIntegerField(default=0, verbose_name='hits')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created at')),
+                (
+                    'last_used_at',
+                    models.DateTimeField(
+                        db_index=True,
+                        default=django.utils.timezone.now,
+                        verbose_name='last used at',
+                    ),
+                ),
+            ],
+            options={
+                'verbose_name': 'completion cache entry',
+                'verbose_name_plural': 'completion cache entries',
+                'ordering': ('-last_used_at',),
+            },
+        ),
+    ]
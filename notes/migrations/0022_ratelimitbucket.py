@@ -0,0 +1,46 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:41
+
+import uuid
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0021_completioncacheentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateLimitBucket',
+            fields=[
+                (
+                    'id',
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='identifier',
+                    ),
+                ),
+                ('name', models.CharField(max_length=128, unique=True, verbose_name='name')),
+                (
+                    'tokens',
+                    models.FloatField(
+                        help_text='Negative when reservations wait for the bucket to refill.',
+                        verbose_name='tokens',
+                    ),
+                ),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='updated at')),
+                ('paused_until', models.DateTimeField(blank=True, null=True, verbose_name='paused until')),
+            ],
+            options={
+                'verbose_name': 'rate limit bucket',
+                'verbose_name_plural': 'rate limit buckets',
+                'ordering': ('name',),
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations
+
+
+def set_schedule_func(func, new_func):
+    def update(apps, schema_editor):
+        Schedule = apps.get_model('django_q', 'Schedule')
+        Schedule.objects.filter(func=func).update(func=new_func)
+    return update
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0022_ratelimitbucket'),
+    ]
+
+    # the schedule only enqueues the backfill to the bulk lane
+    operations = [
+        migrations.RunPython(
+            set_schedule_func('notes.tasks.backfill_note_embeddings', 'notes.tasks.schedule_note_embedding_backfill'),
+            set_schedule_func('notes.tasks.schedule_note_embedding_backfill', 'notes.tasks.backfill_note_embeddings'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0023_backfill_schedule_bulk_lane'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='embedding_claimed_until',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='embedding claimed until'),
+        ),
+    ]
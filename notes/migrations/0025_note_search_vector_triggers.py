@@ -0,0 +1,55 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0024_note_embedding_claimed_until'),
+    ]
+
+    operations = [
+        # notes are written by bulk queries too, so the database keeps search vectors up to date
+        migrations.RunSQL(
+            sql='''
+                CREATE FUNCTION notes_note_search_vector() RETURNS trigger LANGUAGE plpgsql AS $$
+                BEGIN
+                    NEW.search_vector :=
+                        setweight(to_tsvector('simple', NEW.title), 'A') ||
+                        setweight(to_tsvector('simple', coalesce(
+                            (SELECT string_agg(title, ' ') FROM notes_alias WHERE note_id = NEW.id),
+                            ''
+                        )), 'A') ||
+                        setweight(to_tsvector('simple', NEW.content), 'B');
+                    RETURN NEW;
+                END;
+                $$;
+                CREATE TRIGGER notes_note_search_vector
+                    BEFORE INSERT OR UPDATE OF title, content, search_vector ON notes_note
+                    FOR EACH ROW EXECUTE FUNCTION notes_note_search_vector();
+
+                -- touching the search vector of the note makes the note trigger recompute it
+                CREATE FUNCTION notes_alias_note_search_vector() RETURNS trigger LANGUAGE plpgsql AS $$
+                BEGIN
+                    IF TG_OP <> 'INSERT' THEN
+                        UPDATE notes_note SET search_vector = NULL WHERE id = OLD.note_id;
+                    END IF;
+                    IF TG_OP <> 'DELETE' THEN
+                        UPDATE notes_note SET search_vector = NULL WHERE id = NEW.note_id;
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$;
+                CREATE TRIGGER notes_alias_note_search_vector
+                    AFTER INSERT OR UPDATE OR DELETE ON notes_alias
+                    FOR EACH ROW EXECUTE FUNCTION notes_alias_note_search_vector();
+
+                UPDATE notes_note SET search_vector = NULL;
+            ''',
+            reverse_sql='''
+                DROP TRIGGER notes_alias_note_search_vector ON notes_alias;
+                DROP FUNCTION notes_alias_note_search_vector();
+                DROP TRIGGER notes_note_search_vector ON notes_note;
+                DROP FUNCTION notes_note_search_vector();
+            ''',
+        ),
+    ]
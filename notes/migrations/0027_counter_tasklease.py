@@ -0,0 +1,59 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:06
+
+import uuid
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0026_cache_table'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Counter',
+            fields=[
+                (
+                    'id',
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='identifier',
+                    ),
+                ),
+                ('name', models.CharField(max_length=128, unique=True, verbose_name='name')),
+                ('value', models.FloatField(default=0, verbose_name='value')),
+            ],
+            options={
+                'verbose_name': 'counter',
+                'verbose_name_plural': 'counters',
+                'ordering': ('name',),
+            },
+        ),
+        migrations.CreateModel(
+            name='TaskLease',
+            fields=[
+                (
+                    'id',
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='identifier',
+                    ),
+                ),
+                ('key', models.CharField(max_length=255, unique=True, verbose_name='key')),
+                ('expires_at', models.DateTimeField(db_index=True, verbose_name='expires at')),
+            ],
+            options={
+                'verbose_name': 'task lease',
+                'verbose_name_plural': 'task leases',
+                'ordering': ('expires_at',),
+            },
+        ),
+    ]
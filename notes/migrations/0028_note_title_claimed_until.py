@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0027_counter_tasklease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='title_claimed_until',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='title claimed until'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:13
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0028_note_title_claimed_until'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reference',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='created at'),
+        ),
+    ]
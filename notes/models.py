@@ -1,14 +1,26 @@
+import hashlib
+import re
 import uuid
+from datetime import timedelta
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models
-from django.db.models import Q
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVectorField, TrigramSimilarity
+from django.db import connections, models, transaction
+from django.db.models import Case, Exists, F, Max, Min, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import MD5, Coalesce, Greatest, Upper
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from django_q.tasks import async_task
-from pgvector.django import CosineDistance, VectorField
+from pgvector.django import (
+    BitField, CosineDistance, HalfVector, HalfVectorField, HammingDistance, HnswIndex, VectorField,
+)
 
-from .openai import generate_embedding
+from .embedding_backends import get_embedding_backend, get_search_embedding_backend
+from .openai import (
+    SHORT_EMBEDDING_DIMENSIONS, WHITESPACE, generate_query_embedding, quantize_embedding, shorten_embedding,
+)
 
 
 User = get_user_model()
@@ -72,21 +84,311 @@ class NotebookUserPermission(models.Model):
 
 
 class NoteQuerySet(models.QuerySet):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # HNSW index scan options, set when the results are fetched
+        self._hnsw_search = None
+
     def accessible_by_user(self, user):
         return self.filter(notebook__user_permissions__user=user)
 
-    def autocomplete_search(self, query):
+    def autocomplete_search(self, query, fuzzy=False):
+        """
+        Notes with a title or an alias starting with the query, case insensitive.
+        With `fuzzy`, notes with a title or alias similar to the query are matched too
+        and results are ordered by similarity.
+        """
+        if not query:
+            return self
+        pattern = query.upper()
+        condition = Q(upper_title__startswith=pattern)
+        if fuzzy:
+            condition |= Q(upper_title__trigram_similar=pattern)
+        # union of two index scans, a join to aliases would need DISTINCT
+        matching_ids = Note.objects.alias(
+            upper_title=Upper('title'),
+        ).filter(condition).order_by().values('id').union(
+            Alias.objects.alias(
+                upper_title=Upper('title'),
+            ).filter(condition).order_by().values('note_id'),
+        )
+        notes = self.filter(id__in=matching_ids)
+        if fuzzy:
+            alias_similarity = Alias.objects.filter(
+                note=OuterRef('pk'),
+            ).order_by().values('note').annotate(
+                similarity=Max(TrigramSimilarity('title', query)),
+            ).values('similarity')
+            notes = notes.annotate(
+                similarity=Greatest(
+                    TrigramSimilarity('title', query),
+                    Coalesce(Subquery(alias_similarity), 0.0),
+                ),
+            ).order_by('-similarity')
+        return notes
+
+    def with_embeddings(self):
+        return self.defer(None)
+
+    def with_stale_embedding(self):
+        """
+        Notes that have no embedding or whose content changed since it was generated.
+        """
+        return self.filter(STALE_EMBEDDING_CONDITION).exclude(BLANK_CONTENT_CONDITION)
+
+    def with_unclaimed_stale_embedding(self):
+        """
+        Notes with stale embedding that no running embedding task works on.
+        """
+        return self.with_stale_embedding().without_embedding_claim()
+
+    def without_embedding_claim(self):
+        """
+        Notes that no running embedding or backfill task works on.
+        """
         return self.filter(
-            Q(title__istartswith=query) |
-            Q(aliases__title__istartswith=query)
+            Q(embedding_claimed_until__isnull=True) | Q(embedding_claimed_until__lt=timezone.now()),
+        )
+
+    def with_pending_title(self):
+        """
+        Notes without a title, but with content to make it from.
+        """
+        return self.filter(title='').exclude(BLANK_CONTENT_CONDITION)
+
+    def with_unclaimed_pending_title(self):
+        """
+        Notes without a title that no running titling task works on.
+        """
+        return self.with_pending_title().filter(
+            Q(title_claimed_until__isnull=True) | Q(title_claimed_until__lt=timezone.now()),
         )
 
-    def embedding_search(self, query):
-        embedding = generate_embedding(query)
-        return self.annotate(
+    def embedding_search(self, query, **kwargs):
+        """
+        Order notes by semantic similarity to the query. See `nearest_to_embedding()` for options.
+        """
+        return self.nearest_to_embedding(generate_query_embedding(query), **kwargs)
+
+    def nearest_to_embedding(self, embedding, ef_search=None, rerank_candidates=None, prefilter=None, backend=None):
+        """
+        Order notes by distance to the embedding.
+
+        Candidates are found with an HNSW index and reranked by distance between full embeddings.
+        `prefilter` selects the index, it defaults to `settings.EMBEDDING_SEARCH_PREFILTER`:
+        'binary' compares sign bits of embeddings by Hamming distance,
+        'short' compares short embeddings by cosine distance.
+        `rerank_candidates` defaults to `settings.EMBEDDING_SEARCH_RERANK_CANDIDATES`,
+        with 0 notes are ordered by the HNSW index on `embedding_half` instead.
+        Either way results are approximate. `ef_search` trades speed for recall,
+        it defaults to `settings.EMBEDDING_SEARCH_EF_SEARCH`.
+
+        `backend` defaults to `settings.EMBEDDING_SEARCH_BACKEND`. The 'numpy' backend is exact,
+        but returns only the `rerank_candidates` nearest notes of every notebook.
+
+        Only notes embedded by `settings.EMBEDDING_BACKEND` are considered, while it changes
+        some notes still have embeddings of the previous model, which are not comparable.
+        """
+        notes = self.embedded_with(get_embedding_backend())
+        if rerank_candidates is None:
+            rerank_candidates = settings.EMBEDDING_SEARCH_RERANK_CANDIDATES
+        if backend is None:
+            backend = settings.EMBEDDING_SEARCH_BACKEND
+        if backend == 'numpy':
+            return notes._numpy_embedding_search(
+                embedding,
+                k=rerank_candidates or settings.EMBEDDING_SEARCH_RERANK_CANDIDATES,
+            )
+        if not rerank_candidates:
+            return notes._with_hnsw_search(ef_search).annotate(
+                distance=CosineDistance('embedding_half', HalfVector(embedding)),
+            ).order_by('distance')
+
+        if prefilter is None:
+            prefilter = settings.EMBEDDING_SEARCH_PREFILTER
+        if prefilter == 'binary':
+            prefilter_distance = HammingDistance('embedding_binary', quantize_embedding(embedding))
+        elif prefilter == 'short':
+            prefilter_distance = CosineDistance('embedding_short', shorten_embedding(embedding))
+        else:
+            raise ValueError(f'Unknown embedding search prefilter: {prefilter}')
+        candidate_ids = notes.order_by(prefilter_distance).values('id')[:rerank_candidates]
+        # an index scan returns at most ef_search rows
+        notes = notes._with_hnsw_search(max(ef_search or settings.EMBEDDING_SEARCH_EF_SEARCH, rerank_candidates))
+        return notes.filter(id__in=candidate_ids).annotate(
             distance=CosineDistance('embedding', embedding),
         ).order_by('distance')
 
+    def chunk_search(self, query, candidates=None):
+        """
+        Order notes by semantic similarity of their best matching chunk to the query.
+
+        Chunks of the `candidates` nearest notes are found with the HNSW index on chunk embeddings,
+        it defaults to `settings.EMBEDDING_SEARCH_RERANK_CANDIDATES`.
+        Only chunks embedded by the search embedding backend are considered.
+        """
+        backend = get_search_embedding_backend()
+        embedding = HalfVector(generate_query_embedding(query, backend))
+        if candidates is None:
+            candidates = settings.EMBEDDING_SEARCH_RERANK_CANDIDATES
+        chunks = NoteChunk.objects.embedded_with(backend)
+        candidate_ids = chunks.filter(
+            note__in=self.values('id'),
+        ).order_by(
+            CosineDistance('embedding', embedding),
+        ).values('note_id')[:candidates]
+        best_distance = chunks.filter(
+            note=OuterRef('pk'),
+        ).order_by().values('note').annotate(
+            distance=Min(CosineDistance('embedding', embedding)),
+        ).values('distance')
+        notes = self._with_hnsw_search(max(settings.EMBEDDING_SEARCH_EF_SEARCH, candidates))
+        return notes.filter(id__in=candidate_ids).annotate(
+            distance=Subquery(best_distance),
+        ).order_by('distance')
+
+    def embedded_with(self, backend):
+        """
+        Notes whose embedding was generated by the backend.
+        """
+        return self.filter(embedding_model=backend.model, embedding_dimensions=backend.dimensions)
+
+    def not_embedded_with(self, backend):
+        """
+        Notes with content, but without chunks embedded by the backend.
+        """
+        return self.exclude(BLANK_CONTENT_CONDITION).exclude(
+            Exists(NoteChunk.objects.embedded_with(backend).filter(note=OuterRef('pk'))),
+        )
+
+    def neighbours_of(self, note):
+        """
+        Nearest notes of the note, read from the precomputed neighbour table.
+        """
+        return self.filter(
+            neighbour_of__note=note,
+        ).annotate(
+            distance=F('neighbour_of__distance'),
+        ).order_by('distance')
+
+    def lexical_search(self, query):
+        """
+        Full text search in titles, aliases and content. Every word of the query matches as a prefix.
+        """
+        words = re.findall(r'\w+', query)
+        if not words:
+            return self.none()
+        search_query = SearchQuery(
+            ' & '.join(f'{word}:*' for word in words),
+            config=SEARCH_CONFIG,
+            search_type='raw',
+        )
+        return self.filter(
+            search_vector=search_query,
+        ).annotate(
+            lexical_rank=SearchRank(F('search_vector'), search_query),
+        ).order_by('-lexical_rank')
+
+    def hybrid_search(self, query, candidates=50, fuzzy=False, semantic=True):
+        """
+        Merge lexical and semantic search results with reciprocal rank fusion.
+        Each search contributes its top `candidates` notes, semantic search only those
+        closer than `settings.HYBRID_SEARCH_MAX_DISTANCE`, it has some nearest notes for any query.
+        With `fuzzy`, typo tolerant title and alias matches are merged in too.
+        Without `semantic` the query is not embedded, which costs an API call.
+        """
+        if not query.strip():
+            return self
+        rankings = [self.lexical_search(query).values_list('id', flat=True)[:candidates]]
+        if semantic:
+            rankings.append(self.chunk_search(query).filter(
+                distance__lte=settings.HYBRID_SEARCH_MAX_DISTANCE,
+            ).values_list('id', flat=True)[:candidates])
+        if fuzzy:
+            rankings.append(self.autocomplete_search(query, fuzzy=True).values_list('id', flat=True)[:candidates])
+
+        scores = {}
+        for ids in rankings:
+            for rank, note_id in enumerate(ids, start=1):
+                scores[note_id] = scores.get(note_id, 0) + 1 / (RRF_K + rank)
+        ranking = sorted(scores, key=scores.get, reverse=True)
+        if not ranking:
+            return self.none()
+        return self.filter(id__in=ranking).annotate(
+            search_rank=Case(
+                *(When(id=note_id, then=Value(position)) for position, note_id in enumerate(ranking)),
+            ),
+        ).order_by('search_rank')
+
+    def _numpy_embedding_search(self, embedding, k):
+        from .vector_index import NotebookVectorIndex
+        distances = {}
+        for notebook_id in self.order_by().values_list('notebook_id', flat=True).distinct():
+            [results] = NotebookVectorIndex(notebook_id).search([embedding], k)
+            distances.update(results)
+        if not distances:
+            return self.none()
+        return self.filter(id__in=distances).annotate(
+            distance=Case(
+                *(When(id=note_id, then=Value(distance)) for note_id, distance in distances.items()),
+                output_field=models.FloatField(),
+            ),
+        ).order_by('distance')
+
+    def _with_hnsw_search(self, ef_search=None):
+        if ef_search is None:
+            ef_search = settings.EMBEDDING_SEARCH_EF_SEARCH
+        clone = self._chain()
+        clone._hnsw_search = (ef_search, settings.EMBEDDING_SEARCH_ITERATIVE_SCAN)
+        return clone
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._hnsw_search = self._hnsw_search
+        return clone
+
+    def _fetch_all(self):
+        if self._result_cache is not None or self._hnsw_search is None:
+            return super()._fetch_all()
+        ef_search, iterative_scan = self._hnsw_search
+        # local to the transaction, so the options don't leak into other queries of the connection
+        with transaction.atomic(using=self.db):
+            with connections[self.db].cursor() as cursor:
+                cursor.execute(
+                    "SELECT set_config('hnsw.ef_search', %s, true), set_config('hnsw.iterative_scan', %s, true)",
+                    [str(ef_search), iterative_scan],
+                )
+            super()._fetch_all()
+
+
+# no stemming, notes can be written in any language
+SEARCH_CONFIG = 'simple'
+# reciprocal rank fusion constant, dampens the impact of top ranks
+RRF_K = 60
+
+# embeddings are about 12 KB per note and only needed by search and embedding tasks,
+# the search vector is not needed in python at all
+DEFERRED_FIELDS = ('embedding', 'embedding_half', 'embedding_short', 'embedding_binary', 'search_vector')
+
+
+class NoteManager(models.Manager.from_queryset(NoteQuerySet)):
+    def get_queryset(self):
+        return super().get_queryset().defer(*DEFERRED_FIELDS)
+
+
+# derived from `embedding` by `Note.set_embedding()`
+EMBEDDING_COPY_FIELDS = ('embedding_half', 'embedding_short', 'embedding_binary')
+
+STALE_EMBEDDING_CONDITION = Q(embedding__isnull=True) | ~Q(embedding_fingerprint=MD5('content'))
+# content without any words has no chunks, so it never gets an embedding,
+# postgres `\s` misses unicode whitespace like no-break space
+BLANK_CONTENT_CONDITION = Q(content__regex=f'^[{WHITESPACE}]*$')
+
+
+def get_content_fingerprint(content):
+    # same as postgres `md5(content)`
+    return hashlib.md5(content.encode()).hexdigest()
+
 
 class NoteState(models.TextChoices):
     SUGGESTED = 'suggested', _('Suggested')
@@ -127,6 +429,68 @@ class Note(models.Model):
         null=True,
         blank=True,
     )
+    # half precision copy of `embedding`, plain vectors above 2000 dimensions can't be indexed
+    embedding_half = HalfVectorField(
+        dimensions=3072,
+        verbose_name=_('embedding (half precision)'),
+        null=True,
+        blank=True,
+        editable=False,
+    )
+    # truncated and renormalized copy of `embedding`, cheap to index and compare
+    embedding_short = VectorField(
+        dimensions=SHORT_EMBEDDING_DIMENSIONS,
+        verbose_name=_('embedding (short)'),
+        null=True,
+        blank=True,
+        editable=False,
+    )
+    # sign bits of `embedding`, 32 times smaller, compared by Hamming distance
+    embedding_binary = BitField(
+        length=3072,
+        verbose_name=_('embedding (binary)'),
+        null=True,
+        blank=True,
+        editable=False,
+    )
+    embedding_model = models.CharField(
+        max_length=64,
+        blank=True,
+        editable=False,
+        verbose_name=_('embedding model'),
+    )
+    embedding_dimensions = models.PositiveIntegerField(
+        null=True,
+        editable=False,
+        verbose_name=_('embedding dimensions'),
+    )
+    embedding_fingerprint = models.CharField(
+        max_length=32,
+        blank=True,
+        editable=False,
+        verbose_name=_('embedding fingerprint'),
+        help_text=_('Fingerprint of the content the embedding was generated from.'),
+    )
+    # set while an embedding task works on the note, see `claim_pending_note_embeddings` task
+    embedding_claimed_until = models.DateTimeField(
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name=_('embedding claimed until'),
+    )
+    # set while a titling task works on the note, see `claim_pending_note_titles` task
+    title_claimed_until = models.DateTimeField(
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name=_('title claimed until'),
+    )
+    # maintained by database triggers, from title, aliases and content
+    search_vector = SearchVectorField(
+        null=True,
+        editable=False,
+        verbose_name=_('search vector'),
+    )
     generating_references = models.BooleanField(
         default=False,
         verbose_name=_('generating QA'),
@@ -141,12 +505,50 @@ class Note(models.Model):
         verbose_name=_('referenced notes'),
     )
 
-    objects = NoteQuerySet.as_manager()
+    objects = NoteManager()
 
     class Meta:
         verbose_name = _('note')
         verbose_name_plural = _('notes')
         ordering = ('notebook', 'title', 'id')
+        # related notes (e.g. reference target notes) don't load embeddings either
+        base_manager_name = 'objects'
+        indexes = (
+            HnswIndex(
+                name='note_embedding_half_hnsw',
+                fields=('embedding_half',),
+                opclasses=('halfvec_cosine_ops',),
+                m=16,
+                ef_construction=64,
+            ),
+            HnswIndex(
+                name='note_embedding_short_hnsw',
+                fields=('embedding_short',),
+                opclasses=('vector_cosine_ops',),
+                m=16,
+                ef_construction=64,
+            ),
+            HnswIndex(
+                name='note_embedding_binary_hnsw',
+                fields=('embedding_binary',),
+                opclasses=('bit_hamming_ops',),
+                m=16,
+                ef_construction=64,
+            ),
+            GinIndex(
+                OpClass(Upper('title'), name='gin_trgm_ops'),
+                name='note_title_trgm',
+            ),
+            GinIndex(
+                name='note_search_vector',
+                fields=('search_vector',),
+            ),
+            models.Index(
+                name='note_stale_embedding',
+                fields=('id',),
+                condition=STALE_EMBEDDING_CONDITION,
+            ),
+        )
 
     def __str__(self):
         return self.title or str(self.id)
@@ -155,25 +557,77 @@ class Note(models.Model):
         return reverse('notes:note:root', kwargs={'note_id': self.id})
 
     def save(self, *args, update_fields=None, **kwargs):
+        if (
+            'embedding' not in self.get_deferred_fields() and
+            (update_fields is None or 'embedding' in update_fields)
+        ):
+            self.set_embedding(self.embedding)
+            if update_fields is not None:
+                update_fields = [*update_fields, *EMBEDDING_COPY_FIELDS]
         super().save(*args, update_fields=update_fields, **kwargs)
         if (
             not self.title and
             (update_fields is None or 'title' in update_fields)
         ):
-            from .tasks import generate_note_title
-            async_task(generate_note_title, note_id=self.id)
+            from .tasks import schedule_pending_note_titles
+            schedule_pending_note_titles()
         if (
-            self.embedding is None and
-            (update_fields is None or 'embedding' in update_fields)
+            self.has_stale_embedding and
+            (update_fields is None or 'content' in update_fields or 'embedding' in update_fields)
         ):
-            from .tasks import generate_note_embedding
-            async_task(generate_note_embedding, note_id=self.id)
+            from .tasks import schedule_pending_note_embeddings
+            schedule_pending_note_embeddings()
+
+    def refresh_from_db(self, using=None, fields=None):
+        # the base manager defers some fields, so we load them with a separate query
+        if fields is None:
+            deferred_fields = self.get_deferred_fields()
+            manager_deferred_fields = [field for field in DEFERRED_FIELDS if field not in deferred_fields]
+        else:
+            manager_deferred_fields = [field for field in DEFERRED_FIELDS if field in fields]
+            fields = [field for field in fields if field not in DEFERRED_FIELDS]
+        if fields is None or fields:
+            super().refresh_from_db(using=using, fields=fields)
+        if manager_deferred_fields:
+            values = self.__class__._base_manager.db_manager(
+                using, hints={'instance': self},
+            ).with_embeddings().filter(pk=self.pk).values(*manager_deferred_fields).get()
+            for attname, value in values.items():
+                setattr(self, attname, value)
+
+    def set_embedding(self, embedding):
+        self.embedding = embedding
+        self.embedding_half = embedding
+        self.embedding_short = None if embedding is None else shorten_embedding(embedding)
+        self.embedding_binary = None if embedding is None else quantize_embedding(embedding)
+
+    @property
+    def has_stale_embedding(self):
+        # fingerprint is only set together with the embedding, so we don't need to load it
+        return self.embedding_fingerprint != get_content_fingerprint(self.content)
+
+    def schedule_generate_references(self, use_cache=True):
+        """
+        With `use_cache=False` responses cached before now are not used.
+        Nothing is enqueued while a task for the same content is queued or running, returns if it was enqueued.
+        """
+        from .task_queues import INTERACTIVE, get_task_queue
+        from .tasks import async_task_once, generate_note_references
 
-    def schedule_generate_references(self):
-        self.generating_references = True
-        self.save(update_fields=['generating_references'])
-        from .tasks import generate_note_references
-        async_task(generate_note_references, note_id=self.id)
+        with transaction.atomic():
+            self.generating_references = True
+            self.save(update_fields=['generating_references'])
+            enqueued = async_task_once(
+                generate_note_references,
+                key=f'generate_references:{self.id}:{get_content_fingerprint(self.content)}',
+                note_id=self.id,
+                cached_after=None if use_cache else timezone.now(),
+                cluster=get_task_queue(INTERACTIVE),
+            )
+            if not enqueued:
+                # the task already queued or running resets the flag when it finishes, not this one
+                transaction.set_rollback(True)
+        return enqueued
 
     def set_aliases(self, aliases):
         to_delete = {
@@ -240,6 +694,12 @@ class Alias(models.Model):
             ('note', 'title'),
         )
         ordering = ('note', 'title')
+        indexes = (
+            GinIndex(
+                OpClass(Upper('title'), name='gin_trgm_ops'),
+                name='alias_title_trgm',
+            ),
+        )
 
 
 class ReferenceState(models.TextChoices):
@@ -280,6 +740,11 @@ class Reference(models.Model):
         related_name='references_to',
         verbose_name=_('target note'),
     )
+    created_at = models.DateTimeField(
+        default=timezone.now,
+        editable=False,
+        verbose_name=_('created at'),
+    )
 
     objects = ReferenceQuerySet.as_manager()
 
@@ -319,3 +784,413 @@ class Reference(models.Model):
 
 
 NoteReference = Reference
+
+
+class NoteNeighbour(models.Model):
+    """
+    One of the semantically nearest notes in the same notebook, maintained by `update_note_neighbours` task.
+    """
+    id = models.UUIDField(
+        primary_key=True,
+        default=uuid.uuid4,
+        editable=False,
+        verbose_name=_('identifier'),
+    )
+    note = models.ForeignKey(
+        to=Note,
+        on_delete=models.CASCADE,
+        related_name='neighbours',
+        verbose_name=_('note'),
+    )
+    neighbour = models.ForeignKey(
+        to=Note,
+        on_delete=models.CASCADE,
+        related_name='neighbour_of',
+        verbose_name=_('neighbour'),
+    )
+    distance = models.FloatField(
+        verbose_name=_('distance'),
+    )
+
+    class Meta:
+        verbose_name = _('note neighbour')
+        verbose_name_plural = _('note neighbours')
+        unique_together = (
+            ('note', 'neighbour'),
+        )
+        ordering = ('note', 'distance')
+        indexes = (
+            models.Index(
+                name='note_neighbour_distance',
+                fields=('note', 'distance'),
+            ),
+        )
+
+
+class NoteChunkQuerySet(models.QuerySet):
+    def embedded_with(self, backend):
+        return self.filter(embedding_model=backend.model, embedding_dimensions=backend.dimensions)
+
+
+class NoteChunk(models.Model):
+    """
+    Part of note content embedded on its own, so that long notes are searchable by any of their parts.
+    """
+    id = models.UUIDField(
+        primary_key=True,
+        default=uuid.uuid4,
+        editable=False,
+        verbose_name=_('identifier'),
+    )
+    note = models.ForeignKey(
+        to=Note,
+        on_delete=models.CASCADE,
+        related_name='chunks',
+        verbose_name=_('note'),
+    )
+    position = models.PositiveIntegerField(
+        verbose_name=_('position'),
+    )
+    content = models.TextField(
+        verbose_name=_('content'),
+    )
+    embedding = HalfVectorField(
+        dimensions=3072,
+        verbose_name=_('embedding'),
+    )
+    embedding_model = models.CharField(
+        max_length=64,
+        blank=True,
+        verbose_name=_('embedding model'),
+    )
+    embedding_dimensions = models.PositiveIntegerField(
+        null=True,
+        verbose_name=_('embedding dimensions'),
+    )
+
+    objects = NoteChunkQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _('note chunk')
+        verbose_name_plural = _('note chunks')
+        ordering = ('note', 'position')
+        indexes = (
+            HnswIndex(
+                name='note_chunk_embedding_hnsw',
+                fields=('embedding',),
+                opclasses=('halfvec_cosine_ops',),
+                m=16,
+                ef_construction=64,
+            ),
+        )
+
+
+class EmbeddingCacheQuerySet(models.QuerySet):
+    def lookup(self, text_hashes, model, dimensions):
+        """
+        Return cached embeddings as a dict keyed by text hash.
+        Found entries are marked as recently used.
+        """
+        entries = list(self.filter(
+            text_hash__in=text_hashes,
+            model=model,
+            dimensions=dimensions,
+        ).only('id', 'text_hash', 'embedding'))
+        self.filter(id__in=[entry.id for entry in entries]).update(
+            last_used_at=timezone.now(),
+            hits=F('hits') + 1,
+        )
+        return {entry.text_hash: entry.embedding for entry in entries}
+
+    def store(self, embeddings, model, dimensions):
+        """
+        Store embeddings given as a dict keyed by text hash, then evict least recently used entries.
+        """
+        self.bulk_create([
+            EmbeddingCacheEntry(
+                text_hash=text_hash,
+                model=model,
+                dimensions=dimensions,
+                embedding=embedding,
+            )
+            for text_hash, embedding in embeddings.items()
+        ], ignore_conflicts=True)
+        self.evict()
+
+    def evict(self):
+        stale_ids = self.order_by('-last_used_at').values('id')[settings.EMBEDDING_CACHE_MAX_ENTRIES:]
+        self.filter(id__in=stale_ids).delete()
+
+
+class EmbeddingCacheEntry(models.Model):
+    id = models.UUIDField(
+        primary_key=True,
+        default=uuid.uuid4,
+        editable=False,
+        verbose_name=_('identifier'),
+    )
+    text_hash = models.CharField(
+        max_length=64,
+        verbose_name=_('text hash'),
+        help_text=_('SHA-256 of the normalized text.'),
+    )
+    model = models.CharField(
+        max_length=64,
+        verbose_name=_('model'),
+    )
+    dimensions = models.PositiveIntegerField(
+        verbose_name=_('dimensions'),
+    )
+    embedding = VectorField(
+        verbose_name=_('embedding'),
+    )
+    hits = models.PositiveIntegerField(
+        default=0,
+        verbose_name=_('hits'),
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name=_('created at'),
+    )
+    last_used_at = models.DateTimeField(
+        default=timezone.now,
+        db_index=True,
+        verbose_name=_('last used at'),
+    )
+
+    objects = EmbeddingCacheQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _('embedding cache entry')
+        verbose_name_plural = _('embedding cache entries')
+        unique_together = (
+            ('text_hash', 'model', 'dimensions'),
+        )
+        ordering = ('-last_used_at',)
+
+
+class CompletionCacheQuerySet(models.QuerySet):
+    def fresh(self):
+        return self.filter(created_at__gt=timezone.now() - timedelta(seconds=settings.COMPLETION_CACHE_TTL))
+
+    def lookup(self, request_hashes, created_after=None):
+        """
+        Return cached responses as a dict keyed by request hash, expired entries are skipped.
+        With `created_after`, entries stored before that time are skipped too.
+        Found entries are marked as recently used.
+        """
+        entries = self.fresh().filter(request_hash__in=request_hashes)
+        if created_after is not None:
+            entries = entries.filter(created_at__gte=created_after)
+        entries = list(entries.only('id', 'request_hash', 'response'))
+        self.filter(id__in=[entry.id for entry in entries]).update(
+            last_used_at=timezone.now(),
+            hits=F('hits') + 1,
+        )
+        return {entry.request_hash: entry.response for entry in entries}
+
+    def store(self, responses, models):
+        """
+        Store responses given as a dict keyed by request hash, replacing older ones, then evict.
+        `models` maps request hashes to the model names.
+        """
+        self.bulk_create([
+            CompletionCacheEntry(
+                request_hash=request_hash,
+                model=models[request_hash],
+                response=response,
+            )
+            for request_hash, response in responses.items()
+        ], update_conflicts=True, unique_fields=('request_hash',), update_fields=(
+            'response', 'created_at', 'last_used_at',
+        ))
+        self.evict()
+
+    def evict(self):
+        self.exclude(id__in=self.fresh().values('id')).delete()
+        stale_ids = self.order_by('-last_used_at').values('id')[settings.COMPLETION_CACHE_MAX_ENTRIES:]
+        self.filter(id__in=stale_ids).delete()
+
+
+class CompletionCacheEntry(models.Model):
+    id = models.UUIDField(
+        primary_key=True,
+        default=uuid.uuid4,
+        editable=False,
+        verbose_name=_('identifier'),
+    )
+    request_hash = models.CharField(
+        max_length=64,
+        unique=True,
+        verbose_name=_('request hash'),
+        help_text=_('SHA-256 of the model, messages, response format and max tokens.'),
+    )
+    model = models.CharField(
+        max_length=64,
+        verbose_name=_('model'),
+    )
+    response = models.JSONField(
+        verbose_name=_('response'),
+    )
+    hits = models.PositiveIntegerField(
+        default=0,
+        verbose_name=_('hits'),
+    )
+    created_at = models.DateTimeField(
+        default=timezone.now,
+        verbose_name=_('created at'),
+    )
+    last_used_at = models.DateTimeField(
+        default=timezone.now,
+        db_index=True,
+        verbose_name=_('last used at'),
+    )
+
+    objects = CompletionCacheQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _('completion cache entry')
+        verbose_name_plural = _('completion cache entries')
+        ordering = ('-last_used_at',)
+
+
+class RateLimitBucket(models.Model):
+    """
+    Token bucket shared by all processes, see `rate_limit` module.
+    """
+    id = models.UUIDField(
+        primary_key=True,
+        default=uuid.uuid4,
+        editable=False,
+        verbose_name=_('identifier'),
+    )
+    name = models.CharField(
+        max_length=128,
+        unique=True,
+        verbose_name=_('name'),
+    )
+    tokens = models.FloatField(
+        verbose_name=_('tokens'),
+        help_text=_('Negative when reservations wait for the bucket to refill.'),
+    )
+    updated_at = models.DateTimeField(
+        default=timezone.now,
+        verbose_name=_('updated at'),
+    )
+    paused_until = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name=_('paused until'),
+    )
+
+    class Meta:
+        verbose_name = _('rate limit bucket')
+        verbose_name_plural = _('rate limit buckets')
+        ordering = ('name',)
+
+    def __str__(self):
+        return self.name
+
+
+class CounterQuerySet(models.QuerySet):
+    def increment(self, values):
+        """
+        Add values given as a dict keyed by counter name, counters start from zero.
+        The addition happens in the database, so concurrent increments never overwrite each other.
+        """
+        for name, value in values.items():
+            if not value:
+                continue
+            counters = self.filter(name=name)
+            if not counters.update(value=F('value') + value):
+                self.bulk_create([Counter(name=name)], ignore_conflicts=True)
+                counters.update(value=F('value') + value)
+
+    def assign(self, values):
+        """
+        Set counters given as a dict of values keyed by name.
+        """
+        self.bulk_create([
+            Counter(name=name, value=value)
+            for name, value in values.items()
+        ], update_conflicts=True, unique_fields=('name',), update_fields=('value',))
+
+    def get_values(self, names):
+        return dict(self.filter(name__in=names).values_list('name', 'value'))
+
+
+class Counter(models.Model):
+    """
+    Statistics shared by all processes, like queue waits and cache hits.
+    """
+    id = models.UUIDField(
+        primary_key=True,
+        default=uuid.uuid4,
+        editable=False,
+        verbose_name=_('identifier'),
+    )
+    name = models.CharField(
+        max_length=128,
+        unique=True,
+        verbose_name=_('name'),
+    )
+    value = models.FloatField(
+        default=0,
+        verbose_name=_('value'),
+    )
+
+    objects = CounterQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _('counter')
+        verbose_name_plural = _('counters')
+        ordering = ('name',)
+
+    def __str__(self):
+        return self.name
+
+
+class TaskLeaseQuerySet(models.QuerySet):
+    def acquire(self, key, timeout):
+        """
+        Take the lease unless it is held, returns whether it was taken. It expires after `timeout` seconds.
+        Taken in the current transaction, so a rolled back transaction leaves the lease free.
+        """
+        now = timezone.now()
+        self.filter(expires_at__lte=now).delete()
+        _, created = self.get_or_create(key=key, defaults={'expires_at': now + timedelta(seconds=timeout)})
+        return created
+
+    def release(self, key):
+        self.filter(key=key).delete()
+
+
+class TaskLease(models.Model):
+    """
+    Key held by a queued or running task, or by a batch window, so that the task is not enqueued twice.
+    """
+    id = models.UUIDField(
+        primary_key=True,
+        default=uuid.uuid4,
+        editable=False,
+        verbose_name=_('identifier'),
+    )
+    key = models.CharField(
+        max_length=255,
+        unique=True,
+        verbose_name=_('key'),
+    )
+    expires_at = models.DateTimeField(
+        db_index=True,
+        verbose_name=_('expires at'),
+    )
+
+    objects = TaskLeaseQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _('task lease')
+        verbose_name_plural = _('task leases')
+        ordering = ('expires_at',)
+
+    def __str__(self):
+        return self.key
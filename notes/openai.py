@@ -1,17 +1,518 @@
+import asyncio
+import functools
+import hashlib
+import json
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy
 import openai
 from django.conf import settings
+from django.core.cache import cache
 
 
-openai_client = openai.Client(
-    api_key=settings.OPENAI_API_KEY,
-)
+# size of embeddings stored in the database, all embedding backends produce this many dimensions
+EMBEDDING_DIMENSIONS = 3072
+# text-embedding-3 models are trained so that a prefix of the embedding is a usable embedding on its own
+SHORT_EMBEDDING_DIMENSIONS = 256
+
+# worker threads run OpenAI calls on their own event loop, so a single task can keep many requests in flight
+_async_state = threading.local()
+
+
+def get_async_openai_client():
+    """
+    Async client bound to this thread's event loop, it keeps connections open between tasks.
+    """
+    if not hasattr(_async_state, 'client'):
+        _async_state.loop = asyncio.new_event_loop()
+        _async_state.client = openai.AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+        )
+    return _async_state.client
+
+
+def run_concurrently(requests, concurrency=None, return_exceptions=False):
+    """
+    Await coroutine functions of `requests`, at most `settings.OPENAI_CONCURRENCY` at once.
+    Results are returned in the same order, the first exception is raised unless `return_exceptions`.
+    """
+    if concurrency is None:
+        concurrency = settings.OPENAI_CONCURRENCY
+    get_async_openai_client()
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(request):
+            async with semaphore:
+                return await request()
+
+        return await asyncio.gather(
+            *(run(request) for request in requests),
+            return_exceptions=return_exceptions,
+        )
+
+    return _async_state.loop.run_until_complete(run_all())
+
+
+def run_rate_limited(requests, interactive=False):
+    """
+    Like `run_concurrently`, for `(model, estimated tokens, coroutine function)` requests to the API.
+
+    Every request waits for its reservation in the shared rate limits before it is sent.
+    Requests rejected for exceeding a limit pause the model for everyone and are sent again,
+    up to `settings.OPENAI_RATE_LIMIT_ATTEMPTS` times.
+    `interactive` requests use their own share of the limits, see `rate_limit` module.
+    """
+    from . import rate_limit
+
+    results = [None] * len(requests)
+    pending = list(range(len(requests)))
+    for attempt in range(settings.OPENAI_RATE_LIMIT_ATTEMPTS):
+        waits = rate_limit.reserve([requests[i][:2] for i in pending], interactive)
+        outcomes = run_concurrently([
+            functools.partial(send_after, wait, requests[i][2])
+            for i, wait in zip(pending, waits)
+        ], return_exceptions=True)
+        rejected = []
+        for i, outcome in zip(pending, outcomes):
+            if isinstance(outcome, openai.RateLimitError):
+                rate_limit.pause(requests[i][0], outcome.response.headers)
+                if attempt + 1 < settings.OPENAI_RATE_LIMIT_ATTEMPTS:
+                    rejected.append(i)
+                    continue
+            if isinstance(outcome, BaseException):
+                raise outcome
+            results[i] = outcome
+        pending = rejected
+        if not pending:
+            break
+    return results
+
+
+async def send_after(delay, request):
+    await asyncio.sleep(delay)
+    return await request()
+
+
+def estimate_request_tokens(request):
+    """
+    Tokens the API counts against the limit when it receives a chat completion request.
+    """
+    return sum(estimate_tokens(message['content']) for message in request['messages']) + request.get('max_tokens', 0)
+
+
+def create_chat_completions(requests, use_cache=True):
+    """
+    Send many chat completion requests (keyword arguments of `chat.completions.create`) concurrently.
+
+    Responses to requests with `temperature=0` are cached, `use_cache=False` asks the model again
+    and replaces the cached response.
+    """
+    from .models import CompletionCacheEntry
+
+    request_hashes = [
+        get_completion_request_hash(request) if request.get('temperature') == 0 else None
+        for request in requests
+    ]
+    cached = {}
+    if use_cache:
+        cached = CompletionCacheEntry.objects.lookup({
+            request_hash for request_hash in request_hashes if request_hash is not None
+        })
+    missing = [
+        (request, request_hash)
+        for request, request_hash in zip(requests, request_hashes)
+        if request_hash not in cached
+    ]
+
+    client = get_async_openai_client()
+    new_responses = run_rate_limited([
+        (
+            request['model'],
+            estimate_request_tokens(request),
+            functools.partial(client.chat.completions.create, **request),
+        )
+        for request, _ in missing
+    ])
+    responses = {
+        request_hash: response.model_dump(mode='json')
+        for (_, request_hash), response in zip(missing, new_responses)
+        if request_hash is not None
+    }
+    if responses:
+        CompletionCacheEntry.objects.store(responses, models={
+            request_hash: request['model']
+            for request, request_hash in missing
+        })
+
+    new_responses = iter(new_responses)
+    return [
+        openai.types.chat.ChatCompletion.model_validate(cached[request_hash])
+        if request_hash in cached else next(new_responses)
+        for request_hash in request_hashes
+    ]
+
+
+def get_completion_request_hash(request):
+    key = json.dumps([
+        request['model'],
+        request['messages'],
+        request.get('response_format'),
+        request.get('max_tokens'),
+    ], sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def create_chat_completion(use_cache=True, **request):
+    return create_chat_completions([request], use_cache=use_cache)[0]
+
+
+def stream_chat_completion(use_cache=True, cached_after=None, **request):
+    """
+    Yield pieces of the response content as they arrive.
+    A cached response is yielded whole, a streamed one is cached once it is complete.
+    With `cached_after` only a response cached since then is used.
+    """
+    from .models import CompletionCacheEntry
+
+    request_hash = get_completion_request_hash(request) if request.get('temperature') == 0 else None
+    if use_cache and request_hash is not None:
+        cached = CompletionCacheEntry.objects.lookup({request_hash}, created_after=cached_after)
+        if request_hash in cached:
+            yield openai.types.chat.ChatCompletion.model_validate(cached[request_hash]).choices[0].message.content
+            return
+
+    client = get_async_openai_client()
+    loop = _async_state.loop
+    [stream] = run_rate_limited([(
+        request['model'],
+        estimate_request_tokens(request),
+        functools.partial(client.chat.completions.create, stream=True, **request),
+    )])
+    chunks = aiter(stream)
+    content = []
+    finish_reason = None
+    try:
+        while True:
+            try:
+                chunk = loop.run_until_complete(anext(chunks))
+            except StopAsyncIteration:
+                break
+            for choice in chunk.choices:
+                if choice.delta.content:
+                    content.append(choice.delta.content)
+                    yield choice.delta.content
+                finish_reason = choice.finish_reason or finish_reason
+    finally:
+        loop.run_until_complete(stream.aclose())
+
+    if request_hash is not None and finish_reason is not None:
+        response = openai.types.chat.ChatCompletion(
+            id=chunk.id,
+            created=chunk.created,
+            model=chunk.model,
+            object='chat.completion',
+            choices=[{
+                'index': 0,
+                'finish_reason': finish_reason,
+                'message': {'role': 'assistant', 'content': ''.join(content)},
+            }],
+        )
+        CompletionCacheEntry.objects.store(
+            {request_hash: response.model_dump(mode='json')},
+            models={request_hash: request['model']},
+        )
+
+
+def iter_json_array_items(pieces, key):
+    """
+    Yield items of the array under `key` of a JSON object arriving in pieces, each as soon as it is complete.
+    Items are expected to be strings or other values with a closing delimiter.
+    """
+    decoder = json.JSONDecoder()
+    separator = re.compile(r'[\s,]*')
+    text = ''
+    position = None
+    for piece in pieces:
+        text += piece
+        if position is None:
+            match = re.search(r'"%s"\s*:\s*\[' % re.escape(key), text)
+            if match is None:
+                continue
+            position = match.end()
+        while True:
+            start = separator.match(text, position).end()
+            if start >= len(text) or text[start] == ']':
+                break
+            try:
+                item, position = decoder.raw_decode(text, start)
+            except json.JSONDecodeError:
+                # the item is not complete yet
+                break
+            yield item
 
 
 def generate_embedding(text):
-    response = openai_client.embeddings.create(
-        input=text,
-        model='text-embedding-3-large',
+    return generate_embeddings([text])[0]
+
+
+def generate_embeddings(texts, backend=None, interactive=False):
+    """
+    Embed many texts in a single request. Embeddings are returned in the same order as texts.
+    Texts that were embedded before are served from the embedding cache.
+    `backend` defaults to the one selected by `settings.EMBEDDING_BACKEND`.
+    `interactive` is for requests someone waits for, see `rate_limit` module.
+    """
+    from .embedding_backends import get_embedding_backend
+    from .models import EmbeddingCacheEntry
+
+    if backend is None:
+        backend = get_embedding_backend()
+    texts = [normalize_text(text) for text in texts]
+    text_hashes = [get_text_hash(text) for text in texts]
+    embeddings = EmbeddingCacheEntry.objects.lookup(
+        set(text_hashes),
+        model=backend.model,
+        dimensions=backend.dimensions,
+    )
+    missing_texts = {
+        text_hash: text
+        for text_hash, text in zip(text_hashes, texts)
+        if text_hash not in embeddings
+    }
+    count_embedding_cache_usage(
+        hits=len(text_hashes) - len(missing_texts),
+        misses=len(missing_texts),
     )
-    embedding = response.data[0].embedding
-    assert len(embedding) == 3072
-    return embedding
+
+    if missing_texts:
+        new_embeddings = dict(zip(
+            missing_texts.keys(),
+            request_embeddings(list(missing_texts.values()), backend, interactive),
+        ))
+        EmbeddingCacheEntry.objects.store(
+            new_embeddings,
+            model=backend.model,
+            dimensions=backend.dimensions,
+        )
+        embeddings.update(new_embeddings)
+
+    return [embeddings[text_hash] for text_hash in text_hashes]
+
+
+def request_embeddings(texts, backend, interactive=False):
+    embeddings = backend.embed(texts, interactive=interactive)
+    assert len(embeddings) == len(texts)
+    assert all(len(embedding) == backend.dimensions for embedding in embeddings)
+    return embeddings
+
+
+def shorten_embedding(embedding, dimensions=SHORT_EMBEDDING_DIMENSIONS):
+    """
+    Truncate the embedding and scale it back to unit length.
+    """
+    embedding = numpy.asarray(embedding[:dimensions], dtype=numpy.float32)
+    norm = numpy.linalg.norm(embedding)
+    if not norm:
+        # sparse embeddings, like the hashing ones, may have nothing in the leading dimensions
+        return embedding
+    return embedding / norm
+
+
+def quantize_embedding(embedding):
+    """
+    Sign bits of the embedding as a bit string, same as pgvector `binary_quantize()`.
+    """
+    return ''.join(numpy.where(numpy.asarray(embedding) > 0, '1', '0'))
+
+
+def split_into_batches(texts):
+    """
+    Group texts into requests of at most `settings.EMBEDDING_BATCH_SIZE` texts
+    and `settings.EMBEDDING_BATCH_MAX_TOKENS` tokens.
+    """
+    batch = []
+    batch_tokens = 0
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if batch and (
+            len(batch) >= settings.EMBEDDING_BATCH_SIZE or
+            batch_tokens + tokens > settings.EMBEDDING_BATCH_MAX_TOKENS
+        ):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(text)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+# characters matched by `\s`, all of them are in the basic multilingual plane
+WHITESPACE = ''.join(char for char in map(chr, range(0x10000)) if char.isspace())
+
+
+def split_into_chunks(text):
+    """
+    Split the text at word boundaries into chunks of about `settings.NOTE_CHUNK_TOKENS` tokens.
+    Each chunk repeats about `settings.NOTE_CHUNK_OVERLAP_TOKENS` tokens from the end of the previous one.
+    """
+    words = re.findall(r'\S+\s*', text)
+    word_tokens = [estimate_tokens(word) for word in words]
+    chunks = []
+    start = 0
+    while start < len(words):
+        end = start
+        tokens = 0
+        while end < len(words) and (end == start or tokens + word_tokens[end] <= settings.NOTE_CHUNK_TOKENS):
+            tokens += word_tokens[end]
+            end += 1
+        chunks.append(''.join(words[start:end]).strip())
+        if end == len(words):
+            break
+        # step back over the overlap, but always move forward
+        overlap_start = end
+        overlap_tokens = 0
+        while overlap_start - 1 > start and overlap_tokens < settings.NOTE_CHUNK_OVERLAP_TOKENS:
+            overlap_start -= 1
+            overlap_tokens += word_tokens[overlap_start]
+        start = overlap_start
+    return chunks
+
+
+def normalize_text(text):
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+def get_text_hash(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+EMBEDDING_CACHE_HITS_KEY = 'notes:embedding-cache:hits'
+EMBEDDING_CACHE_MISSES_KEY = 'notes:embedding-cache:misses'
+
+
+def count_embedding_cache_usage(hits, misses):
+    from .models import Counter
+
+    Counter.objects.increment({
+        EMBEDDING_CACHE_HITS_KEY: hits,
+        EMBEDDING_CACHE_MISSES_KEY: misses,
+    })
+
+
+def get_embedding_cache_stats():
+    from .models import Counter
+
+    counters = Counter.objects.get_values([EMBEDDING_CACHE_HITS_KEY, EMBEDDING_CACHE_MISSES_KEY])
+    return {
+        'hits': int(counters.get(EMBEDDING_CACHE_HITS_KEY, 0)),
+        'misses': int(counters.get(EMBEDDING_CACHE_MISSES_KEY, 0)),
+    }
+
+
+QUERY_EMBEDDING_CACHE_STATS = ('local_hits', 'shared_hits', 'misses', 'evictions')
+
+
+def get_query_embedding_counter(name):
+    return f'notes:query-embedding-cache:{name}'
+
+
+class QueryEmbeddingCache:
+    """
+    In-process LRU of search query embeddings, backed by the shared Django cache.
+    Entries expire after `ttl` seconds in both. Hits and misses are counted over all processes.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_embedding(self, query, backend=None):
+        from .embedding_backends import get_embedding_backend
+
+        if backend is None:
+            backend = get_embedding_backend()
+        text = normalize_text(query)
+        key = f'notes:query-embedding:{backend.model}:{backend.dimensions}:{get_text_hash(text)}'
+
+        embedding = self.get_local(key)
+        if embedding is not None:
+            self.count(local_hits=1)
+            return embedding
+
+        data = cache.get(key)
+        if data is not None:
+            embedding = numpy.frombuffer(data, dtype=numpy.float32)
+            stats = {'shared_hits': 1}
+        else:
+            embedding = numpy.array(generate_embeddings([text], backend, interactive=True)[0], dtype=numpy.float32)
+            cache.set(key, embedding.tobytes(), timeout=self.ttl)
+            stats = {'misses': 1}
+        evictions = self.set_local(key, embedding)
+        self.count(evictions=evictions, **stats)
+        return embedding
+
+    def get_local(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            embedding, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return embedding
+
+    def set_local(self, key, embedding):
+        """
+        Returns the number of evicted entries.
+        """
+        evictions = 0
+        with self.lock:
+            self.entries[key] = (embedding, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                evictions += 1
+        return evictions
+
+    def count(self, **stats):
+        from .models import Counter
+
+        Counter.objects.increment({get_query_embedding_counter(name): value for name, value in stats.items()})
+
+    def get_stats(self):
+        from .models import Counter
+
+        names = {name: get_query_embedding_counter(name) for name in QUERY_EMBEDDING_CACHE_STATS}
+        counters = Counter.objects.get_values(names.values())
+        stats = {name: int(counters.get(counter_name, 0)) for name, counter_name in names.items()}
+        total = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+        return {
+            **stats,
+            'hit_rate': (stats['local_hits'] + stats['shared_hits']) / total if total else None,
+        }
+
+
+query_embedding_cache = QueryEmbeddingCache(
+    max_entries=settings.QUERY_EMBEDDING_CACHE_MAX_ENTRIES,
+    ttl=settings.QUERY_EMBEDDING_CACHE_TTL,
+)
+
+
+def generate_query_embedding(query, backend=None):
+    return query_embedding_cache.get_embedding(query, backend)
+
+
+def estimate_tokens(text):
+    # rough upper bound, english text averages about 4 characters per token
+    return len(text) // 3 + 1
@@ -0,0 +1,146 @@
+"""
+Requests and tokens per minute limits of the OpenAI API, shared by all workers and web processes.
+
+Every model has two token buckets in the database, refilled at `settings.OPENAI_REQUESTS_PER_MINUTE`
+and `settings.OPENAI_TOKENS_PER_MINUTE`. Callers reserve estimated tokens before sending a request.
+A reservation always succeeds, it may take the bucket below zero and tells the caller how long to wait
+for the bucket to refill. Concurrent callers thus queue up behind each other instead of all sending
+and being rejected, which keeps the throughput just under the quota.
+
+Interactive callers, like search query embeddings, have buckets of their own with
+`settings.OPENAI_INTERACTIVE_SHARE` of the limits, so they never queue up behind bulk work
+that reserved minutes ahead.
+
+When the API rejects a request anyway, the buckets of the model are paused for as long as response headers say.
+"""
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import RateLimitBucket
+
+
+# pause when a rejected response doesn't say for how long
+DEFAULT_PAUSE = 1.0
+
+
+def get_bucket_limits(model, interactive=False):
+    """
+    Per minute limits of the model by bucket name, zero limit means no bucket.
+    """
+    if not settings.OPENAI_INTERACTIVE_SHARE:
+        lane, share = 'bulk', 1
+    elif interactive:
+        lane, share = 'interactive', settings.OPENAI_INTERACTIVE_SHARE
+    else:
+        lane, share = 'bulk', 1 - settings.OPENAI_INTERACTIVE_SHARE
+    limits = {
+        f'openai:{model}:{lane}:requests': settings.OPENAI_REQUESTS_PER_MINUTE * share,
+        f'openai:{model}:{lane}:tokens': settings.OPENAI_TOKENS_PER_MINUTE * share,
+    }
+    return {name: limit for name, limit in limits.items() if limit}
+
+
+def lock_buckets(limits):
+    """
+    Buckets of the limits by name, locked for update. Missing ones are created full.
+    """
+    def select():
+        return {
+            bucket.name: bucket
+            for bucket in RateLimitBucket.objects.select_for_update().filter(name__in=limits).order_by('name')
+        }
+
+    buckets = select()
+    if len(buckets) < len(limits):
+        RateLimitBucket.objects.bulk_create([
+            RateLimitBucket(name=name, tokens=limit)
+            for name, limit in limits.items()
+            if name not in buckets
+        ], ignore_conflicts=True)
+        buckets = select()
+    return buckets
+
+
+def reserve(requests, interactive=False):
+    """
+    Reserve capacity for requests given as `(model, estimated tokens)` pairs, in one transaction.
+    Returns seconds each request has to wait before it can be sent.
+    """
+    limits = {}
+    for model, _ in requests:
+        limits.update(get_bucket_limits(model, interactive))
+    if not limits:
+        return [0.0] * len(requests)
+
+    with transaction.atomic():
+        buckets = lock_buckets(limits)
+        # after the lock, time spent waiting for it refilled the buckets too
+        now = timezone.now()
+        for name, bucket in buckets.items():
+            elapsed = max((now - bucket.updated_at).total_seconds(), 0)
+            bucket.tokens = min(limits[name], bucket.tokens + elapsed * limits[name] / 60)
+            bucket.updated_at = now
+
+        waits = []
+        for model, tokens in requests:
+            wait = 0.0
+            for name, limit in get_bucket_limits(model, interactive).items():
+                bucket = buckets[name]
+                bucket.tokens -= 1 if name.endswith(':requests') else tokens
+                wait = max(wait, -bucket.tokens * 60 / limit)
+                if bucket.paused_until is not None:
+                    wait = max(wait, (bucket.paused_until - now).total_seconds())
+            waits.append(wait)
+        RateLimitBucket.objects.bulk_update(buckets.values(), ['tokens', 'updated_at'])
+    return waits
+
+
+def pause(model, headers):
+    """
+    Stop sending requests for the model after it was rejected with headers `headers`.
+    """
+    limits = {**get_bucket_limits(model), **get_bucket_limits(model, interactive=True)}
+    if not limits:
+        return
+    paused_until = timezone.now() + timedelta(seconds=get_pause_duration(headers))
+    with transaction.atomic():
+        for bucket in lock_buckets(limits).values():
+            if bucket.paused_until is None or bucket.paused_until < paused_until:
+                bucket.paused_until = paused_until
+            # we were sending too fast, so what we thought is left is not there
+            bucket.tokens = min(bucket.tokens, 0)
+            bucket.save(update_fields=['paused_until', 'tokens'])
+
+
+def get_pause_duration(headers):
+    """
+    Seconds to wait according to `retry-after` or `x-ratelimit-reset-*` headers.
+    """
+    if 'retry-after-ms' in headers:
+        return float(headers['retry-after-ms']) / 1000
+    if 'retry-after' in headers:
+        try:
+            return float(headers['retry-after'])
+        except ValueError:
+            pass
+    resets = [
+        parse_duration(headers[header])
+        for header in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens')
+        if header in headers
+    ]
+    return max(resets, default=DEFAULT_PAUSE)
+
+
+def parse_duration(value):
+    """
+    Seconds of a duration like `1m30s`, `6.5s` or `120ms`.
+    """
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    parts = re.findall(r'([\d.]+)(ms|h|m|s)', value)
+    if not parts:
+        return DEFAULT_PAUSE
+    return sum(float(number) * units[unit] for number, unit in parts)
@@ -0,0 +1,191 @@
+"""
+django-q broker on Postgres, selected with `Q_CLUSTER['broker_class']`.
+
+Tasks are rows of the `orm` broker table, inserted on the default connection, so a task enqueued in a transaction
+exists only once the transaction commits, together with the notes it refers to. Workers claim tasks with
+`SELECT ... FOR UPDATE SKIP LOCKED`, so concurrent clusters never fight over the same rows. Enqueue sends
+`NOTIFY` (delivered on commit too) and an idle cluster waits for it on a `LISTEN` connection instead of polling.
+
+`async_task_on_commit` buffers tasks enqueued in a transaction and inserts them all with one query on commit,
+tasks of rolled back savepoints left out.
+"""
+import select
+import threading
+from time import sleep
+
+from django.db import DatabaseError, connections, transaction
+from django.utils import timezone
+from django_q.brokers.orm import ORM, _timeout
+from django_q.conf import Conf, logger
+from django_q.models import OrmQ
+from django_q.tasks import async_task
+
+
+# tasks become available without notification too, when the lock of a task not acknowledged in time expires
+LISTEN_TIMEOUT = 5
+
+
+class PostgresBroker(ORM):
+    def __init__(self, list_key=None):
+        super().__init__(list_key=list_key)
+        self.listener = None
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.listener = None
+
+    def info(self):
+        if not self._info:
+            self._info = f'Postgres {Conf.ORM}'
+        return self._info
+
+    def enqueue(self, task):
+        task_id = super().enqueue(task)
+        with connections[Conf.ORM].cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [get_channel(self.list_key or Conf.CLUSTER_NAME), ''])
+        return task_id
+
+    def dequeue(self):
+        # listen before looking at the queue, a task enqueued in between still wakes us up
+        self.listen()
+        tasks = self.claim()
+        if tasks:
+            return tasks
+        self.wait(LISTEN_TIMEOUT)
+
+    def claim(self):
+        """
+        Lock available tasks for this cluster, skipping rows claimed by others right now.
+        """
+        with transaction.atomic(using=Conf.ORM):
+            tasks = list(
+                self.get_connection()
+                .filter(key=self.list_key, lock__lt=timezone.now())
+                .select_for_update(skip_locked=True)
+                .order_by('id')
+                .values_list('id', 'payload')[:Conf.BULK]
+            )
+            if tasks:
+                self.get_connection().filter(id__in=[task_id for task_id, _ in tasks]).update(lock=_timeout())
+        return tasks
+
+    def listen(self):
+        if self.listener is not None:
+            return
+        database = connections[Conf.ORM]
+        try:
+            with database.wrap_database_errors:
+                self.listener = database.get_new_connection(database.get_connection_params())
+                self.listener.autocommit = True
+                with self.listener.cursor() as cursor:
+                    cursor.execute(f'LISTEN {database.ops.quote_name(get_channel(self.list_key))}')
+        except DatabaseError:
+            logger.exception('Failed to listen for tasks, falling back to polling')
+            self.close_listener()
+
+    def wait(self, timeout):
+        """
+        Block until a task is enqueued or the timeout passes, return whether a notification arrived.
+        """
+        if self.listener is None:
+            sleep(Conf.POLL)
+            return False
+        try:
+            with connections[Conf.ORM].wrap_database_errors:
+                if not self.listener.notifies:
+                    select.select([self.listener], [], [], timeout)
+                    self.listener.poll()
+            notified = bool(self.listener.notifies)
+            self.listener.notifies.clear()
+            return notified
+        except (DatabaseError, OSError):
+            logger.exception('Lost connection listening for tasks')
+            self.close_listener()
+            return False
+
+    def close_listener(self):
+        if self.listener is not None:
+            self.listener.close()
+        self.listener = None
+
+
+def get_channel(queue):
+    return f'django_q:{queue}'
+
+
+def bulk_enqueue(tasks):
+    """
+    Insert `(queue, signed task)` pairs with one query and wake up the clusters of their queues.
+    """
+    OrmQ.objects.using(Conf.ORM).bulk_create([
+        OrmQ(key=queue, payload=task, lock=timezone.now())
+        for queue, task in tasks
+    ])
+    with connections[Conf.ORM].cursor() as cursor:
+        for queue in dict.fromkeys(queue for queue, _ in tasks):
+            cursor.execute('SELECT pg_notify(%s, %s)', [get_channel(queue), ''])
+
+
+def async_task_on_commit(func, *args, **kwargs):
+    """
+    `async_task` deferred to the commit of the current transaction, so the task never runs before the rows
+    it refers to are visible, or at all if the transaction is rolled back.
+    Tasks of a transaction are inserted together. Outside of a transaction the task is enqueued right away.
+    """
+    return async_task(func, *args, broker=TransactionBroker(kwargs.get('cluster')), **kwargs)
+
+
+class TransactionBroker(PostgresBroker):
+    def enqueue(self, task):
+        connection = connections[Conf.ORM]
+        if not connection.in_atomic_block:
+            return super().enqueue(task)
+        get_pending_tasks(connection).append((self.list_key, task))
+
+
+_pending = threading.local()
+
+
+class PendingTasks(list):
+    """
+    Tasks enqueued in a savepoint, the commit hook handing them over to the transaction.
+    """
+    def __init__(self, transaction_tasks):
+        super().__init__()
+        self.transaction_tasks = transaction_tasks
+
+    def __call__(self):
+        self.transaction_tasks.extend(self)
+        self.clear()
+
+
+class TransactionTasks(list):
+    """
+    Tasks of the savepoints that were not rolled back, the last commit hook inserting them.
+    """
+    def __call__(self):
+        if self:
+            bulk_enqueue(self)
+        self.clear()
+
+
+def get_pending_tasks(connection):
+    # hooks registered in a savepoint are dropped when it rolls back, so each savepoint buffers its own tasks
+    savepoint_ids = tuple(connection.savepoint_ids)
+    hooks = [func for _, func, _ in connection.run_on_commit]
+    # buffers of committed and rolled back transactions have no hook anymore
+    buffers = _pending.buffers = {
+        key: pending_tasks
+        for key, pending_tasks in getattr(_pending, 'buffers', {}).items()
+        if any(func is pending_tasks for func in hooks)
+    }
+    transaction_tasks = getattr(_pending, 'transaction_tasks', None)
+    if not any(func is transaction_tasks for func in hooks):
+        transaction_tasks = _pending.transaction_tasks = TransactionTasks()
+    if savepoint_ids not in buffers:
+        buffers[savepoint_ids] = PendingTasks(transaction_tasks)
+        transaction.on_commit(buffers[savepoint_ids], using=connection.alias)
+        # registered outside of all savepoints, so no rollback drops it, and after the hooks of all buffers
+        connection.run_on_commit = [hook for hook in connection.run_on_commit if hook[1] is not transaction_tasks]
+        connection.run_on_commit.append((set(), transaction_tasks, False))
+    return buffers[savepoint_ids]
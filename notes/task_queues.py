@@ -0,0 +1,66 @@
+"""
+Priority lanes of background tasks.
+
+Every lane is a django-q queue served by its own cluster, started with `Q_CLUSTER_NAME=<lane> ./manage.py qcluster`.
+Workers of a cluster only take tasks of its queue, so each lane has reserved capacity: interactive tasks
+never wait behind a bulk backfill and bulk tasks can't starve them. Lanes not listed in `settings.TASK_LANES`
+are served by the default cluster together with normal tasks.
+"""
+from django.conf import settings
+from django.utils import timezone
+from django_q.conf import Conf
+
+from .models import Counter
+
+
+# started by a user who waits for the result
+INTERACTIVE = 'interactive'
+# follow-ups of edits, like titles and embeddings of saved notes
+NORMAL = 'normal'
+# backfills and long backlogs
+BULK = 'bulk'
+LANES = (INTERACTIVE, NORMAL, BULK)
+
+
+def get_task_queue(lane):
+    """
+    Cluster name to pass as `cluster` option of `async_task`.
+    """
+    if lane in settings.TASK_LANES:
+        return lane
+    return Conf.PREFIX
+
+
+def record_queue_wait(sender, task, **kwargs):
+    """
+    `pre_execute` signal receiver, counts time tasks spent in the queue.
+    """
+    queue = task.get('cluster') or Conf.CLUSTER_NAME
+    wait = max((timezone.now() - task['started']).total_seconds(), 0)
+    Counter.objects.increment({
+        f'notes:task-queue:{queue}:tasks': 1,
+        f'notes:task-queue:{queue}:wait': wait,
+    })
+    Counter.objects.assign({f'notes:task-queue:{queue}:last-wait': wait})
+
+
+def get_queue_wait_stats():
+    """
+    Tasks started, their average and last queue wait in seconds, by queue.
+    """
+    queues = list(dict.fromkeys(get_task_queue(lane) for lane in LANES))
+    counters = Counter.objects.get_values([
+        f'notes:task-queue:{queue}:{name}'
+        for queue in queues
+        for name in ('tasks', 'wait', 'last-wait')
+    ])
+    stats = {}
+    for queue in queues:
+        tasks = int(counters.get(f'notes:task-queue:{queue}:tasks', 0))
+        wait = counters.get(f'notes:task-queue:{queue}:wait', 0)
+        stats[queue] = {
+            'tasks': tasks,
+            'average_wait': wait / tasks if tasks else None,
+            'last_wait': counters.get(f'notes:task-queue:{queue}:last-wait'),
+        }
+    return stats
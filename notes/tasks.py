@@ -1,18 +1,35 @@
-
 import json
+import time
+from datetime import timedelta
 
+import numpy
+from django.conf import settings
 from django.db import transaction
-from django_q.tasks import async_task
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
 from pgvector.django import CosineDistance
 
-from .models import Note, NoteReferenceState, NoteState, Reference
-from .openai import generate_embedding, openai_client
+from .embedding_backends import get_embedding_backend, get_next_embedding_backend, record_backfill_throughput
+from .models import (
+    BLANK_CONTENT_CONDITION, EMBEDDING_COPY_FIELDS, Note, NoteChunk, NoteNeighbour, NoteReferenceState, NoteState,
+    Reference, TaskLease, get_content_fingerprint,
+)
+from .openai import (
+    create_chat_completions, estimate_tokens, generate_embeddings, iter_json_array_items, split_into_chunks,
+    stream_chat_completion,
+)
+from .task_broker import async_task_on_commit
+from .task_queues import BULK, NORMAL, get_task_queue
+from .vector_index import update_vector_indexes
 
 
-def generate_references(note_id):
+def generate_references(note_id, cached_after=None):
     """
     We are making LLM call to generate questions for this note.
     We give it examples of other notes nearby.
+    With `cached_after` the LLM is asked again if it has seen the same prompt only before that time.
+    A retry of the task still gets the response of its first run.
     """
     note = Note.objects.get(id=note_id)
 
@@ -44,38 +61,42 @@ def generate_references(note_id):
         "role": "user",
         "content": note.content,
     })
-    response = openai_client.chat.completions.create(
+    response_pieces = stream_chat_completion(
+        cached_after=cached_after,
         messages=messages,
         response_format={'type': 'json_object'},
         model='gpt-3.5-turbo',
         temperature=0,
         max_tokens=4096,
     )
-    response_parsed = json.loads(response.choices[0].message.content)
-    new_notes_content = response_parsed.get('next', [])
-
-    with transaction.atomic():
-        new_notes = [
-            Note(
-                notebook_id=note.notebook_id,
-                content=content,
-                state=NoteState.SUGGESTED,
-            )
-            for content in new_notes_content
-        ]
-        Note.objects.bulk_create(new_notes)
-        references = [
-            Reference(
+    # a retry of a task killed mid stream gets the same suggestions, the ones saved before are skipped
+    saved_contents = set(note.references.values_list('target_note__content', flat=True))
+    suggestions = (
+        content
+        for content in iter_json_array_items(response_pieces, 'next')
+        if isinstance(content, str) and content and content not in saved_contents
+    )
+    # every suggestion is saved as soon as it arrives, so it shows up while the rest is generated
+    for content, duplicated_note_id in deduplicate_suggested_notes(note, suggestions):
+        with transaction.atomic():
+            if duplicated_note_id is None:
+                target_note = Note(
+                    notebook_id=note.notebook_id,
+                    content=content,
+                    state=NoteState.SUGGESTED,
+                )
+                Note.objects.bulk_create([target_note])
+                duplicated_note_id = target_note.id
+            # the note may already reference the duplicated note
+            Reference.objects.bulk_create([Reference(
                 note=note,
-                target_note=new_note,
+                target_note_id=duplicated_note_id,
                 state=NoteReferenceState.SUGGESTED,
-            )
-            for new_note in new_notes
-        ]
-        Reference.objects.bulk_create(references)
-    for new_note in new_notes:
-        async_task(generate_note_title, note_id=new_note.id)
-        async_task(generate_note_embedding, note_id=new_note.id)
+            )], ignore_conflicts=True)
+            if content is not None:
+                # embedding of the content is cached by now, the tasks are enqueued when the note commits
+                schedule_pending_note_titles()
+                schedule_pending_note_embeddings()
 
     note.generating_references = False
     note.save(update_fields=['generating_references'])
@@ -84,62 +105,478 @@ def generate_references(note_id):
 generate_note_references = generate_references
 
 
+def async_task_once(func, key, **kwargs):
+    """
+    Enqueue the task unless a task with the same idempotency key is queued or running, returns if it was enqueued.
+
+    The task releases the key when it finishes. A task killed by the timeout keeps the key
+    for `settings.TASK_KEY_TIMEOUT`, so its retry by the broker is not doubled by a new task.
+    """
+    lease_key = f'notes:task:{key}'
+    if not TaskLease.objects.acquire(lease_key, timeout=settings.TASK_KEY_TIMEOUT):
+        return False
+    async_task_on_commit(run_task_once, lease_key, func, task_name=key, **kwargs)
+    return True
+
+
+def run_task_once(lease_key, func, **kwargs):
+    try:
+        return func(**kwargs)
+    finally:
+        TaskLease.objects.release(lease_key)
+
+
+def deduplicate_suggested_notes(note, contents):
+    """
+    Yield suggested notes as `(content, None)` for new ones and `(None, note id)` for those duplicating a note.
+
+    Every content is embedded and compared with earlier contents and with notes in the notebook.
+    Anything closer than `settings.NOTE_DUPLICATE_DISTANCE` is a duplicate, a content duplicating
+    an earlier content is dropped, a content duplicating an existing note is replaced by that note.
+    """
+    notebook_notes = Note.objects.filter(
+        notebook_id=note.notebook_id,
+        embedding_half__isnull=False,
+    ).exclude(id=note.id)
+
+    new_embeddings = []
+    duplicated_note_ids = set()
+    for content in contents:
+        embedding = numpy.array(generate_embeddings([content])[0], dtype=numpy.float32)
+        embedding /= numpy.linalg.norm(embedding)
+        if new_embeddings and 1 - max(numpy.array(new_embeddings) @ embedding) < settings.NOTE_DUPLICATE_DISTANCE:
+            continue
+        nearest = notebook_notes.nearest_to_embedding(embedding).values_list('id', 'distance').first()
+        if nearest is not None and nearest[1] < settings.NOTE_DUPLICATE_DISTANCE:
+            if nearest[0] not in duplicated_note_ids:
+                duplicated_note_ids.add(nearest[0])
+                yield None, nearest[0]
+            continue
+        new_embeddings.append(embedding)
+        yield content, None
+
+
 def check_reference_uniqueness(reference_id):
+    """
+    Delete the reference if its note already references a note with nearly the same content.
+    """
     reference = Reference.objects.get(id=reference_id)
+    target_embedding = Note.objects.with_embeddings().values_list(
+        'embedding', flat=True,
+    ).get(id=reference.target_note_id)
+    if target_embedding is None:
+        return
     similar_references = Reference.objects.annotate(
-        distance=CosineDistance('embedding', reference.embedding),
+        distance=CosineDistance('target_note__embedding', target_embedding),
     ).filter(
         note_id=reference.note_id,
-        distance__lt=0.1,
+        distance__lt=settings.NOTE_DUPLICATE_DISTANCE,
     ).exclude(id=reference.id)
     if similar_references.exists():
         reference.delete()
-    else:
-        reference.save(update_fields=['state'])
 
 
 def generate_note_title(note_id):
-    note = Note.objects.get(id=note_id)
+    generate_note_titles([note_id])
+
+
+TITLE_BATCH_LEASE_KEY = 'notes:title-batch-scheduled'
+
+
+def schedule_pending_note_titles():
+    """
+    Enqueue a batch titling task, unless one was enqueued within the batch window.
+    """
+    if TaskLease.objects.acquire(TITLE_BATCH_LEASE_KEY, timeout=settings.NOTE_TITLE_BATCH_WINDOW):
+        async_task_on_commit(generate_pending_note_titles, cluster=get_task_queue(NORMAL))
 
+
+def generate_pending_note_titles():
+    """
+    Title notes without a title, as many as fit in concurrent batch requests.
+    If there are more left, we enqueue ourselves again.
+    """
+    time.sleep(settings.NOTE_TITLE_BATCH_WINDOW)
+    note_ids = claim_pending_note_titles()
+    if not note_ids:
+        return
+
+    generate_note_titles(note_ids)
+    # notes the model skipped stay claimed, so the next batch takes other notes
+    if Note.objects.with_unclaimed_pending_title().exists():
+        async_task_on_commit(generate_pending_note_titles, cluster=get_task_queue(BULK))
+
+
+def claim_pending_note_titles():
+    """
+    Claim ids of notes without a title for `settings.NOTE_TITLE_CLAIM_TIMEOUT`.
+    Notes claimed by concurrent tasks are skipped, so every note is titled by one task only.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        note_ids = list(Note.objects.with_unclaimed_pending_title().order_by('id').select_for_update(
+            skip_locked=True,
+        ).values_list('id', flat=True)[:settings.NOTE_TITLE_BATCH_SIZE * settings.OPENAI_CONCURRENCY])
+        Note.objects.filter(id__in=note_ids).update(
+            title_claimed_until=now + timedelta(seconds=settings.NOTE_TITLE_CLAIM_TIMEOUT),
+        )
+    return note_ids
+
+
+def generate_note_titles(note_ids):
+    """
+    Title notes in batches of `settings.NOTE_TITLE_BATCH_SIZE`, one LLM call per batch.
+    A batch holds notes of a single notebook, they share few-shot examples from that notebook.
+    The calls run concurrently. Returns number of titled notes.
+    """
+    notes_by_notebook = {}
+    for note in Note.objects.filter(id__in=note_ids).order_by('notebook_id', 'id'):
+        notes_by_notebook.setdefault(note.notebook_id, []).append(note)
+    batches = [
+        notebook_notes[i:i + settings.NOTE_TITLE_BATCH_SIZE]
+        for notebook_notes in notes_by_notebook.values()
+        for i in range(0, len(notebook_notes), settings.NOTE_TITLE_BATCH_SIZE)
+    ]
+    responses = create_chat_completions([
+        {
+            'messages': get_note_title_messages(batch),
+            'response_format': {'type': 'json_object'},
+            'model': 'gpt-3.5-turbo',
+            'temperature': 0,
+            'max_tokens': 50 * len(batch),
+        }
+        for batch in batches
+    ])
+
+    titled_notes = []
+    for batch, response in zip(batches, responses):
+        try:
+            titles = json.loads(response.choices[0].message.content).get('titles')
+        except (json.JSONDecodeError, AttributeError):
+            titles = None
+        numbered_notes = number_notes(batch)
+        # a title missing or added anywhere makes the rest ambiguous, the notes wait for the next run
+        if not isinstance(titles, dict) or titles.keys() != numbered_notes.keys():
+            continue
+        for number, note in numbered_notes.items():
+            title = titles[number]
+            if isinstance(title, str) and title:
+                note.title = title[:64]
+                note.title_claimed_until = None
+                titled_notes.append(note)
+    Note.objects.bulk_update(titled_notes, ['title', 'title_claimed_until'])
+    return len(titled_notes)
+
+
+def number_notes(notes):
+    """
+    Notes by their number in a prompt, titles in the response refer to these numbers.
+    """
+    return {str(number): note for number, note in enumerate(notes, start=1)}
+
+
+def get_note_title_messages(notes):
     messages = [
         {
             "role": "system",
-            "content": "Generate a title for note you are given.",
+            "content": (
+                'Generate a title for every note you are given. '
+                'Notes come numbered, in the schema `{"notes": {"1": "...", "2": "...", ...}}`. '
+                'Respond in JSON format, in the schema `{"titles": {"1": "...", "2": "...", ...}}`, '
+                'with the title of every note under its number.'
+            ),
         },
     ]
 
-    example_notes = get_example_notes(note, 3)
-    for example_note in example_notes:
+    # the same examples every time, so that the prompt and its cached completion repeat
+    example_notes = Note.objects.filter(
+        id__in=Note.objects.filter(referenced_notes__in=notes).values('id'),
+    ).exclude(title='').order_by('id')[:3]
+    if example_notes:
+        numbered_examples = number_notes(example_notes)
         messages.append({
             "role": "user",
-            "content": example_note.content,
+            "content": json.dumps({'notes': {
+                number: example_note.content for number, example_note in numbered_examples.items()
+            }}),
         })
         messages.append({
             "role": "assistant",
-            "content": example_note.title,
+            "content": json.dumps({'titles': {
+                number: example_note.title for number, example_note in numbered_examples.items()
+            }}),
         })
 
     messages.append({
         "role": "user",
-        "content": note.content,
+        "content": json.dumps({'notes': {number: note.content for number, note in number_notes(notes).items()}}),
     })
-    response = openai_client.chat.completions.create(
-        messages=messages,
-        model='gpt-3.5-turbo',
-        temperature=0,
-        max_tokens=100,
-    )
-    note.title = response.choices[0].message.content[:64]
-    note.save(update_fields=['title'])
+    return messages
 
 
 def get_example_notes(note, count=3):
+    # not random, a prompt with the same examples is served from the completion cache
     return Note.objects.filter(
         referenced_notes=note,
-    ).order_by('?')[:count]
+    ).order_by('id')[:count]
 
 
 def generate_note_embedding(note_id):
     note = Note.objects.get(id=note_id)
-    note.embedding = generate_embedding(note.content)
-    note.save(update_fields=['embedding'])
+    embed_notes([note])
+
+
+EMBEDDING_BATCH_LEASE_KEY = 'notes:embedding-batch-scheduled'
+
+
+def schedule_pending_note_embeddings():
+    """
+    Enqueue a batch embedding task, unless one was enqueued within the batch window.
+    That task waits out the window, so it will pick up notes saved in the meantime.
+    """
+    if TaskLease.objects.acquire(EMBEDDING_BATCH_LEASE_KEY, timeout=settings.EMBEDDING_BATCH_WINDOW):
+        async_task_on_commit(generate_pending_note_embeddings, cluster=get_task_queue(NORMAL))
+
+
+def generate_pending_note_embeddings():
+    """
+    Embed notes without an up to date embedding, as many as fit in one request.
+    If there are more left, we enqueue ourselves again.
+    Waiting out the window also debounces quick successive edits of a note into one embedding.
+    """
+    time.sleep(settings.EMBEDDING_BATCH_WINDOW)
+    batch = claim_pending_note_embeddings()
+    if not batch:
+        return
+
+    embed_notes(batch)
+    if Note.objects.with_unclaimed_stale_embedding().exists():
+        async_task_on_commit(generate_pending_note_embeddings, cluster=get_task_queue(BULK))
+
+
+def claim_pending_note_embeddings():
+    """
+    Claim a batch of notes with stale embeddings for `settings.EMBEDDING_CLAIM_TIMEOUT`.
+    Notes claimed by concurrent tasks are skipped, so every note is embedded by one task only.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        pending_notes = Note.objects.with_unclaimed_stale_embedding().order_by().only(
+            'id', 'notebook_id', 'content',
+        ).select_for_update(skip_locked=True)
+
+        batch = []
+        batch_tokens = 0
+        for note in pending_notes[:settings.EMBEDDING_BATCH_SIZE]:
+            tokens = estimate_tokens(note.content)
+            if batch and batch_tokens + tokens > settings.EMBEDDING_BATCH_MAX_TOKENS:
+                break
+            batch.append(note)
+            batch_tokens += tokens
+        Note.objects.filter(id__in=[note.id for note in batch]).update(
+            embedding_claimed_until=now + timedelta(seconds=settings.EMBEDDING_CLAIM_TIMEOUT),
+        )
+    return batch
+
+
+def embed_notes(notes):
+    """
+    Embed notes chunk by chunk, the note embedding is the normalized mean of its chunk embeddings.
+    While migrating to the next embedding backend, chunks are embedded with it too.
+    """
+    backend = get_embedding_backend()
+    next_backend = get_next_embedding_backend()
+    chunk_embeddings = embed_note_chunks(notes, backend)
+    if next_backend is not None:
+        embed_note_chunks(notes, next_backend)
+
+    for note in notes:
+        embeddings = chunk_embeddings[note.id]
+        if len(embeddings) == 1:
+            note.set_embedding(embeddings[0])
+        elif embeddings:
+            embedding = numpy.mean(embeddings, axis=0)
+            note.set_embedding(embedding / numpy.linalg.norm(embedding))
+        else:
+            note.set_embedding(None)
+        note.embedding_model = backend.model
+        note.embedding_dimensions = backend.dimensions
+        note.embedding_fingerprint = get_content_fingerprint(note.content)
+        note.embedding_claimed_until = None
+
+    with transaction.atomic():
+        # chunks of models no longer in use
+        unused_chunks = NoteChunk.objects.filter(note__in=notes)
+        for used_backend in filter(None, (backend, next_backend)):
+            unused_chunks = unused_chunks.exclude(
+                embedding_model=used_backend.model,
+                embedding_dimensions=used_backend.dimensions,
+            )
+        unused_chunks.delete()
+        Note.objects.bulk_update(notes, [
+            'embedding',
+            *EMBEDDING_COPY_FIELDS,
+            'embedding_model',
+            'embedding_dimensions',
+            'embedding_fingerprint',
+            'embedding_claimed_until',
+        ])
+    update_vector_indexes(notes)
+    async_task_on_commit(
+        update_note_neighbours,
+        note_ids=[note.id for note in notes],
+        cluster=get_task_queue(NORMAL),
+    )
+
+
+def embed_note_chunks(notes, backend):
+    """
+    Replace chunks of the notes embedded by the backend, returns lists of chunk embeddings by note id.
+    Only chunks with new text are sent to the model, the rest keep their embeddings.
+    """
+    chunk_contents = {note.id: split_into_chunks(note.content) for note in notes}
+    old_chunks = {
+        (chunk.note_id, chunk.content): chunk
+        for chunk in NoteChunk.objects.embedded_with(backend).filter(note__in=notes)
+    }
+    known_embeddings = {key: chunk.embedding.to_numpy() for key, chunk in old_chunks.items()}
+    missing_contents = list(dict.fromkeys(
+        content
+        for note in notes
+        for content in chunk_contents[note.id]
+        if (note.id, content) not in known_embeddings
+    ))
+    new_embeddings = {}
+    if missing_contents:
+        new_embeddings = dict(zip(missing_contents, generate_embeddings(missing_contents, backend)))
+
+    chunk_embeddings = {}
+    kept_chunks = []
+    new_chunks = []
+    for note in notes:
+        chunk_embeddings[note.id] = []
+        for position, content in enumerate(chunk_contents[note.id]):
+            embedding = known_embeddings.get((note.id, content))
+            if embedding is None:
+                embedding = new_embeddings[content]
+            chunk_embeddings[note.id].append(embedding)
+            chunk = old_chunks.pop((note.id, content), None)
+            if chunk is None:
+                new_chunks.append(NoteChunk(
+                    note=note,
+                    position=position,
+                    content=content,
+                    embedding=embedding,
+                    embedding_model=backend.model,
+                    embedding_dimensions=backend.dimensions,
+                ))
+            else:
+                chunk.position = position
+                kept_chunks.append(chunk)
+
+    with transaction.atomic():
+        NoteChunk.objects.filter(id__in=[chunk.id for chunk in old_chunks.values()]).delete()
+        NoteChunk.objects.bulk_update(kept_chunks, ['position'])
+        NoteChunk.objects.bulk_create(new_chunks)
+    return chunk_embeddings
+
+
+def schedule_note_embedding_backfill():
+    """
+    Runs every minute in the default queue, the backfill itself runs in the bulk lane.
+    """
+    async_task_on_commit(backfill_note_embeddings, cluster=get_task_queue(BULK))
+
+
+def backfill_note_embeddings():
+    """
+    See `embedding_backends` module for the whole process.
+
+    Every run first recomputes embeddings of notes that already have chunks of `settings.EMBEDDING_BACKEND`,
+    all of them, because that needs no model calls. Then it embeds a batch of notes embedded by other model.
+    When there are none, it embeds a batch of notes without chunks of `settings.EMBEDDING_NEXT_BACKEND`.
+    Notes are claimed like in `claim_pending_note_embeddings`, so concurrent embedding tasks don't race it.
+    """
+    batch_size = settings.EMBEDDING_BACKFILL_BATCH_SIZE
+    backend = get_embedding_backend()
+    other_notes = Note.objects.exclude(BLANK_CONTENT_CONDITION).exclude(
+        embedding_model=backend.model,
+        embedding_dimensions=backend.dimensions,
+    )
+    # right after the backend switch, so searches don't skip the notes for long
+    while notes := claim_notes(
+        other_notes.exclude(id__in=Note.objects.not_embedded_with(backend).values('id')),
+        settings.EMBEDDING_RECOMPUTE_BATCH_SIZE,
+    ):
+        embed_notes(notes)
+
+    notes = claim_notes(other_notes, batch_size)
+    if notes:
+        with record_backfill_throughput(backend, len(notes)):
+            embed_notes(notes)
+        return
+
+    next_backend = get_next_embedding_backend()
+    if next_backend is None:
+        return
+    notes = claim_notes(Note.objects.not_embedded_with(next_backend), batch_size)
+    if not notes:
+        return
+    with record_backfill_throughput(next_backend, len(notes)):
+        embed_note_chunks(notes, next_backend)
+    Note.objects.filter(id__in=[note.id for note in notes]).update(embedding_claimed_until=None)
+
+
+def claim_notes(notes, limit):
+    """
+    Claim up to `limit` of the notes for `settings.EMBEDDING_CLAIM_TIMEOUT`, skipping notes claimed by other tasks.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        batch = list(notes.without_embedding_claim().order_by('id').only(
+            'id', 'notebook_id', 'content',
+        ).select_for_update(skip_locked=True)[:limit])
+        Note.objects.filter(id__in=[note.id for note in batch]).update(
+            embedding_claimed_until=now + timedelta(seconds=settings.EMBEDDING_CLAIM_TIMEOUT),
+        )
+    return batch
+
+
+def update_note_neighbours(note_ids):
+    """
+    Refresh the neighbour table after embeddings of the notes changed.
+
+    Each note gets its nearest notes as neighbours and enters neighbour lists of nearby notes
+    if it is closer than their farthest neighbour. Lists the note drops out of stay shorter
+    until embeddings of their own notes change, so nothing is recomputed notebook wide.
+    """
+    count = settings.NOTE_NEIGHBOURS_COUNT
+    notes = Note.objects.with_embeddings().embedded_with(get_embedding_backend())
+    for note in notes.filter(id__in=note_ids, embedding__isnull=False):
+        # the note may be among the nearest of notes a bit further than its own nearest
+        nearest = list(Note.objects.filter(
+            notebook_id=note.notebook_id,
+            embedding_half__isnull=False,
+        ).exclude(
+            id=note.id,
+        ).nearest_to_embedding(note.embedding).values_list('id', 'distance')[:count * 2])
+
+        with transaction.atomic():
+            NoteNeighbour.objects.filter(Q(note=note) | Q(neighbour=note)).delete()
+            NoteNeighbour.objects.bulk_create([
+                *(
+                    NoteNeighbour(note=note, neighbour_id=neighbour_id, distance=distance)
+                    for neighbour_id, distance in nearest[:count]
+                ),
+                *(
+                    NoteNeighbour(note_id=neighbour_id, neighbour=note, distance=distance)
+                    for neighbour_id, distance in nearest
+                ),
+            ], ignore_conflicts=True)
+            NoteNeighbour.objects.filter(id__in=NoteNeighbour.objects.filter(
+                note_id__in=[neighbour_id for neighbour_id, _ in nearest],
+            ).alias(
+                rank=Window(RowNumber(), partition_by=F('note_id'), order_by=F('distance').asc()),
+            ).filter(
+                rank__gt=count,
+            ).values('id')).delete()
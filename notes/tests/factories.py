@@ -1,6 +1,6 @@
 import factory
 
-from ..models import Alias, Note, Notebook, NotebookUserPermission, Reference
+from ..models import Alias, Note, Notebook, NotebookUserPermission, NoteChunk, Reference
 
 
 class NotebookFactory(factory.django.DjangoModelFactory):
@@ -19,6 +19,19 @@ class NoteFactory(factory.django.DjangoModelFactory):
 
     notebook = factory.SubFactory(NotebookFactory)
     title = factory.Sequence(lambda n: f'Test note {n}')
+    embedding = None
+    embedding_model = factory.Maybe('embedding', 'text-embedding-3-large', '')
+    embedding_dimensions = factory.Maybe('embedding', 3072, None)
+
+
+class NoteChunkFactory(factory.django.DjangoModelFactory):
+    class Meta:
+        model = NoteChunk
+
+    position = 0
+    content = factory.SelfAttribute('note.content')
+    embedding_model = 'text-embedding-3-large'
+    embedding_dimensions = 3072
 
 
 class AliasFactory(factory.django.DjangoModelFactory):
@@ -1,4 +1,16 @@
+from unittest import mock
+
 import pytest
+from django_q.conf import Conf
+from openai.resources.chat.completions import AsyncCompletions
+from openai.resources.embeddings import AsyncEmbeddings
+from openai.types.chat import ChatCompletionMessage
+from openai.types.chat.chat_completion import ChatCompletion, Choice
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+from openai.types.chat.chat_completion_chunk import Choice as ChunkChoice
+from openai.types.chat.chat_completion_chunk import ChoiceDelta
+from openai.types.create_embedding_response import CreateEmbeddingResponse, Usage
+from openai.types.embedding import Embedding
 
 from .factories import NotebookFactory, NotebookUserPermissionFactory, NoteFactory, NoteReferenceFactory
 
@@ -57,3 +69,85 @@ def other_notebook_note(request, other_notebook):
         notebook=other_notebook,
         **getattr(request, 'param', {}),
     )
+
+
+@pytest.fixture(autouse=True)
+def no_batch_window(settings):
+    # don't wait for notes to accumulate, each save gets its own batch
+    settings.EMBEDDING_BATCH_WINDOW = 0
+    settings.NOTE_TITLE_BATCH_WINDOW = 0
+
+
+@pytest.fixture
+def sync_tasks(monkeypatch):
+    monkeypatch.setattr(Conf, 'SYNC', True)
+
+
+@pytest.fixture
+def chat_completion_mock(monkeypatch):
+    async def create_completion(stream=False, **kwargs):
+        if stream:
+            return stream_completion(completions_mock.return_value)
+        return completions_mock.return_value
+
+    completions_mock = mock.AsyncMock(side_effect=create_completion)
+    completions_mock.return_value = ChatCompletion(
+        choices=[
+            Choice(
+                message=ChatCompletionMessage(
+                    role='assistant',
+                    content='{"next": ["first question", "second question"]}',
+                ),
+                finish_reason='stop',
+                index=0,
+                logprobs=None,
+            ),
+        ],
+        id='cmpl-123',
+        created=1630000000,
+        model='gpt-4-turbo-preview',
+        object='chat.completion',
+    )
+    monkeypatch.setattr(AsyncCompletions, 'create', completions_mock)
+    return completions_mock
+
+
+async def stream_completion(completion, piece_length=5):
+    content = completion.choices[0].message.content
+    deltas = [
+        (ChoiceDelta(content=content[i:i + piece_length]), None)
+        for i in range(0, len(content), piece_length)
+    ]
+    for delta, finish_reason in [*deltas, (ChoiceDelta(), 'stop')]:
+        yield ChatCompletionChunk(
+            choices=[ChunkChoice(delta=delta, finish_reason=finish_reason, index=0)],
+            id=completion.id,
+            created=completion.created,
+            model=completion.model,
+            object='chat.completion.chunk',
+        )
+
+
+@pytest.fixture
+def embedding_mock(monkeypatch):
+    def create_embeddings(input, model):
+        return CreateEmbeddingResponse(
+            data=[
+                Embedding(
+                    embedding=[0.1] * 3072,
+                    index=index,
+                    object='embedding',
+                )
+                for index in range(len(input))
+            ],
+            model=model,
+            object='list',
+            usage=Usage(
+                prompt_tokens=123,
+                total_tokens=456,
+            ),
+        )
+
+    embedding_mock = mock.AsyncMock(side_effect=create_embeddings)
+    monkeypatch.setattr(AsyncEmbeddings, 'create', embedding_mock)
+    return embedding_mock
@@ -17,12 +17,16 @@ def user_notebook(user):
 @pytest.mark.parametrize('term,found', [
     ('Moria', True),  # match in title
     ('kha', True),  # match in alias
-    ('fiction', False),  # match in content
+    ('fiction', True),  # match in content
     ('oria', False),  # match not at the beginning of a word
-    # TODO
-    # ('pit', True),  # match on second word
+    ('pit', True),  # match on second word
+    ('black pi', True),  # all words match
+    ('black shire', False),  # only some words match
+    ('underground caverns of durin', True),  # semantic match
 ])
-def test_note_search(user_client, user_notebook, term, found):
+def test_note_search(user_client, user_notebook, settings, sync_tasks, term, found):
+    # embeddings of the content are close to related queries only
+    settings.EMBEDDING_BACKEND = 'hashing'
     note = NoteFactory(
         notebook=user_notebook,
         title='Moria',
@@ -30,6 +34,7 @@ def test_note_search(user_client, user_notebook, term, found):
     )
     AliasFactory(note=note, title='Khazad-dûm')
     AliasFactory(note=note, title='Black Pit')
+    assert note.chunks.exists()
 
     response = user_client.get(
         reverse('api:note-list'),
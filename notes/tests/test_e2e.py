@@ -1,66 +1,6 @@
-from unittest import mock
-
 import numpy
 import pytest
 from django.urls import reverse
-from django_q.conf import Conf
-from openai.types.chat import ChatCompletionMessage
-from openai.types.chat.chat_completion import ChatCompletion, Choice
-from openai.types.create_embedding_response import CreateEmbeddingResponse, Usage
-from openai.types.embedding import Embedding
-
-from notes.openai import openai_client
-
-
-@pytest.fixture
-def sync_tasks(monkeypatch):
-    monkeypatch.setattr(Conf, 'SYNC', True)
-
-
-@pytest.fixture
-def chat_completion_mock(monkeypatch):
-    completions_mock = mock.Mock()
-    completions_mock.return_value = ChatCompletion(
-        choices=[
-            Choice(
-                message=ChatCompletionMessage(
-                    role='assistant',
-                    content='{"next": ["first question", "second question"]}',
-                ),
-                finish_reason='stop',
-                index=0,
-                logprobs=None,
-            ),
-        ],
-        id='cmpl-123',
-        created=1630000000,
-        model='gpt-4-turbo-preview',
-        object='chat.completion',
-    )
-    monkeypatch.setattr(openai_client.chat.completions, 'create', completions_mock)
-    return completions_mock
-
-
-@pytest.fixture
-def embedding_mock(monkeypatch):
-    embedding_mock = mock.Mock()
-    embedding_mock.return_value = CreateEmbeddingResponse(
-        data=[
-            Embedding(
-                embedding=[0.1] * 3072,
-                index=0,
-                object='embedding',
-            ),
-        ],
-        model='text-embedding-3-large',
-        object='list',
-        usage=Usage(
-            prompt_tokens=123,
-            total_tokens=456,
-        ),
-    )
-    monkeypatch.setattr(openai_client.embeddings, 'create', embedding_mock)
-    return embedding_mock
 
 
 @pytest.mark.django_db
@@ -82,7 +22,7 @@ def test_note_reference_answer(
     chat_completion_mock,
     embedding_mock,
 ):
-    chat_completion_mock.return_value.choices[0].message.content = 'LLM generated title'
+    chat_completion_mock.return_value.choices[0].message.content = '{"titles": {"1": "LLM generated title"}}'
     response = user_client.post(
         reverse('notes:answer:create_answer', kwargs={'note_reference_id': note_reference.id}),
         data={'answer': 'This is an answer'},
@@ -93,5 +33,5 @@ def test_note_reference_answer(
     assert note_reference.target_note.title == 'LLM generated title'
     assert chat_completion_mock.mock_calls[0].kwargs['messages'][-1] == {
         'role': 'user',
-        'content': 'This is an answer',
+        'content': '{"notes": {"1": "This is an answer"}}',
     }
@@ -0,0 +1,87 @@
+from datetime import timedelta
+
+import numpy
+import pytest
+from django.core.cache import cache
+from django.utils import timezone
+
+from ..embedding_backends import (
+    HashingEmbeddingBackend, get_backfill_progress, get_next_embedding_backend, get_search_embedding_backend,
+)
+from ..models import EmbeddingCacheEntry, Note, NoteChunk
+from ..tasks import backfill_note_embeddings
+from .factories import NoteFactory
+
+
+def test_hashing_embedding_backend():
+    backend = HashingEmbeddingBackend()
+    moria, mines_of_moria, shire, empty = map(numpy.array, backend.embed([
+        'Moria', 'The mines of Moria', 'The Shire', '',
+    ]))
+
+    assert numpy.array_equal(moria, backend.embed(['Moria'])[0])
+    assert all(
+        numpy.linalg.norm(embedding) == pytest.approx(1, abs=1e-6)
+        for embedding in (moria, mines_of_moria, shire, empty)
+    )
+    assert moria @ mines_of_moria > moria @ shire
+
+
+@pytest.mark.django_db
+def test_hashing_embedding_backend_search(notebook, settings, sync_tasks):
+    settings.EMBEDDING_BACKEND = 'hashing'
+    note = NoteFactory(notebook=notebook, content='Moria is a complex of caverns and mines')
+    NoteFactory(notebook=notebook, content='The Shire is a region inhabited by hobbits')
+
+    note = Note.objects.with_embeddings().get(id=note.id)
+    assert note.embedding_model == 'hashing'
+    assert note.embedding_dimensions == 3072
+    assert note.chunks.get().embedding_model == 'hashing'
+    assert EmbeddingCacheEntry.objects.filter(model='hashing').count() == 2
+    assert Note.objects.filter(notebook=notebook).chunk_search('caverns of moria').first() == note
+
+
+@pytest.mark.django_db
+def test_embedding_backend_migration(notebook, settings, sync_tasks, embedding_mock):
+    cache.clear()
+    moria = NoteFactory(notebook=notebook, content='Moria is a complex of caverns and mines')
+    NoteFactory(notebook=notebook, content='The Shire is a region inhabited by hobbits')
+    assert embedding_mock.call_count == 2
+
+    settings.EMBEDDING_NEXT_BACKEND = 'hashing'
+    settings.EMBEDDING_BACKFILL_BATCH_SIZE = 1
+    next_backend = get_next_embedding_backend()
+    backfill_note_embeddings()
+    assert get_backfill_progress(next_backend)['done'] == 1
+    assert get_backfill_progress(next_backend)['throughput'] > 0
+
+    # notes claimed by an embedding task are left to it
+    Note.objects.update(embedding_claimed_until=timezone.now() + timedelta(minutes=1))
+    backfill_note_embeddings()
+    assert get_backfill_progress(next_backend)['done'] == 1
+    Note.objects.update(embedding_claimed_until=None)
+
+    # new notes are embedded with both models
+    NoteFactory(notebook=notebook, content='Rivendell is an elven outpost')
+    progress = get_backfill_progress(next_backend)
+    assert (progress['done'], progress['total']) == (2, 3)
+    assert get_search_embedding_backend().model == 'text-embedding-3-large'
+
+    backfill_note_embeddings()
+    backfill_note_embeddings()
+    # the last answer is kept for a while
+    assert get_search_embedding_backend().model == 'text-embedding-3-large'
+    cache.clear()
+    assert get_search_embedding_backend().model == 'hashing'
+    assert Note.objects.filter(notebook=notebook).chunk_search('caverns of moria').first() == moria
+
+    # note embeddings are recomputed from the stored chunks, all at once
+    settings.EMBEDDING_BACKEND = 'hashing'
+    settings.EMBEDDING_NEXT_BACKEND = ''
+    settings.EMBEDDING_RECOMPUTE_BATCH_SIZE = 2
+    embedding_mock.reset_mock()
+    backfill_note_embeddings()
+    assert embedding_mock.call_count == 0
+    assert set(Note.objects.values_list('embedding_model', flat=True)) == {'hashing'}
+    assert set(NoteChunk.objects.values_list('embedding_model', flat=True)) == {'hashing'}
+    assert not Note.objects.filter(embedding_claimed_until__isnull=False).exists()
@@ -0,0 +1,156 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import pytest
+from django.db import connection
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+
+from ..models import Counter, Note, NoteState, TaskLease
+from .factories import AliasFactory, NoteChunkFactory, NoteFactory
+
+
+@pytest.mark.django_db
+def test_embedding_search(notebook, other_notebook, embedding_mock):
+    close_note = NoteFactory(notebook=notebook, embedding=[0.1] * 3072)
+    far_note = NoteFactory(notebook=notebook, embedding=[0.1, -0.1] * 1536)
+    NoteFactory(notebook=notebook, embedding=[0.1] * 3072, state=NoteState.SUGGESTED)
+    NoteFactory(notebook=other_notebook, embedding=[0.1] * 3072)
+    # embedded by the previous model while the embedding backend changes
+    NoteFactory(notebook=notebook, embedding=[0.1] * 3072, embedding_model='hashing')
+
+    notes = Note.objects.filter(
+        notebook=notebook,
+        state=NoteState.ACTIVE,
+    ).embedding_search('query', ef_search=200)
+
+    with CaptureQueriesContext(connection) as queries:
+        assert list(notes) == [close_note, far_note]
+    # set for the transaction of the search only
+    assert any("set_config('hnsw.ef_search', '200', true)" in query['sql'] for query in queries)
+
+
+@pytest.mark.django_db
+def test_embedding_search_rerank(notebook, embedding_mock):
+    # query embedding is [0.1] * 3072
+    short_match_note = NoteFactory(notebook=notebook, embedding=[0.1] * 256 + [-0.1] * 2816)
+    full_match_note = NoteFactory(notebook=notebook, embedding=[0.1, 0.05] * 128 + [0.1] * 2816)
+
+    notes = Note.objects.filter(notebook=notebook)
+    assert list(notes.embedding_search('query', rerank_candidates=1, prefilter='short')) == [short_match_note]
+    assert list(notes.embedding_search('query', rerank_candidates=2, prefilter='short')) == [
+        full_match_note,
+        short_match_note,
+    ]
+    assert list(notes.embedding_search('query', rerank_candidates=0)) == [full_match_note, short_match_note]
+
+
+@pytest.mark.django_db
+def test_embedding_search_binary_prefilter(notebook, embedding_mock):
+    # query embedding is [0.1] * 3072
+    sign_match_note = NoteFactory(notebook=notebook, embedding=[0.01, 1.0] * 1536)
+    full_match_note = NoteFactory(notebook=notebook, embedding=[0.1] * 3000 + [-0.01] * 72)
+
+    notes = Note.objects.filter(notebook=notebook)
+    assert list(notes.embedding_search('query', rerank_candidates=1, prefilter='binary')) == [sign_match_note]
+    assert list(notes.embedding_search('query', rerank_candidates=2, prefilter='binary')) == [
+        full_match_note,
+        sign_match_note,
+    ]
+
+
+@pytest.mark.django_db
+def test_chunk_search(notebook, embedding_mock):
+    # query embedding is [0.1] * 3072
+    long_note = NoteFactory(notebook=notebook)
+    NoteChunkFactory(note=long_note, position=0, embedding=[0.1, -0.1] * 1536)
+    NoteChunkFactory(note=long_note, position=1, embedding=[0.1] * 3072)
+    short_note = NoteFactory(notebook=notebook)
+    NoteChunkFactory(note=short_note, embedding=[0.1, 0.05] * 1536)
+    NoteFactory(notebook=notebook)
+
+    notes = Note.objects.filter(notebook=notebook).chunk_search('query')
+    assert list(notes) == [long_note, short_note]
+    assert notes[0].distance == pytest.approx(0, abs=1e-3)
+
+
+@pytest.mark.django_db
+def test_embeddings_are_deferred(note_reference):
+    note = Note.objects.get(id=note_reference.note_id)
+    assert {'embedding', 'embedding_half'} <= note.get_deferred_fields()
+    target_note = note.references.get().target_note
+    assert {'embedding', 'embedding_half'} <= target_note.get_deferred_fields()
+    assert {'embedding', 'embedding_half'} <= note.notebook.notes.first().get_deferred_fields()
+
+    note = Note.objects.with_embeddings().get(id=note_reference.note_id)
+    assert not note.get_deferred_fields()
+
+
+@pytest.mark.django_db
+def test_hybrid_search(notebook, embedding_mock):
+    lexical_note = NoteFactory(notebook=notebook, content='Durin founded Moria')
+    semantic_note = NoteFactory(notebook=notebook, content='Dwarven halls')
+    NoteChunkFactory(note=semantic_note, embedding=[0.1] * 3072)
+    both_note = NoteFactory(notebook=notebook, title='Moria', content='Mines')
+    NoteChunkFactory(note=both_note, embedding=[0.1, 0.09] * 1536)
+    NoteFactory(notebook=notebook, content='Shire')
+    AliasFactory(note=lexical_note, title='Khazad-dûm')
+
+    notes = Note.objects.filter(notebook=notebook).hybrid_search('moria')
+    assert list(notes) == [both_note, semantic_note, lexical_note]
+
+    notes = Note.objects.filter(notebook=notebook).lexical_search('khazad')
+    assert list(notes) == [lexical_note]
+
+
+@pytest.mark.django_db
+def test_autocomplete_search(notebook):
+    note = NoteFactory(notebook=notebook, title='Lothlorien')
+    AliasFactory(note=note, title='Golden Wood')
+    AliasFactory(note=note, title='Golden Forest')
+    NoteFactory(notebook=notebook, title='Fangorn')
+
+    assert list(Note.objects.autocomplete_search('loth')) == [note]
+    assert list(Note.objects.autocomplete_search('golden')) == [note]
+    assert list(Note.objects.autocomplete_search('Lothlorein')) == []
+    assert list(Note.objects.autocomplete_search('Lothlorein', fuzzy=True)) == [note]
+
+
+@pytest.mark.django_db
+def test_hybrid_search_fuzzy(notebook, embedding_mock):
+    note = NoteFactory(notebook=notebook, title='Lothlorien')
+
+    assert list(Note.objects.hybrid_search('Lothlorein')) == []
+    assert list(Note.objects.hybrid_search('Lothlorein', fuzzy=True)) == [note]
+
+
+def increment_in_thread(values):
+    try:
+        Counter.objects.increment(values)
+    finally:
+        connection.close()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_counter_increment():
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(increment_in_thread, [{'tasks': 1, 'wait': 0.5}] * 20))
+
+    assert Counter.objects.get_values(['tasks', 'wait', 'missing']) == {'tasks': 20, 'wait': 10}
+    Counter.objects.assign({'wait': 1})
+    assert Counter.objects.get_values(['wait']) == {'wait': 1}
+
+
+@pytest.mark.django_db
+def test_task_lease():
+    assert TaskLease.objects.acquire('some-task', timeout=60)
+    assert not TaskLease.objects.acquire('some-task', timeout=60)
+    assert TaskLease.objects.acquire('other-task', timeout=60)
+
+    TaskLease.objects.release('some-task')
+    assert TaskLease.objects.acquire('some-task', timeout=60)
+
+    # the lease of a killed task expires
+    TaskLease.objects.update(expires_at=F('expires_at') - timedelta(minutes=2))
+    assert TaskLease.objects.acquire('some-task', timeout=60)
+    assert TaskLease.objects.count() == 1
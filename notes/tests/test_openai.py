@@ -0,0 +1,144 @@
+import asyncio
+
+import pytest
+from django.core.cache import cache
+
+from ..models import CompletionCacheEntry, EmbeddingCacheEntry
+from ..openai import (
+    QueryEmbeddingCache, create_chat_completion, generate_embedding, generate_embeddings, get_embedding_cache_stats,
+    iter_json_array_items, run_concurrently, stream_chat_completion,
+)
+
+
+@pytest.mark.django_db
+def test_generate_embeddings_cache(embedding_mock):
+    stats_before = get_embedding_cache_stats()
+
+    embeddings = generate_embeddings(['Moria', ' Moria\n', 'Black Pit'])
+    assert len(embeddings) == 3
+    assert embedding_mock.call_count == 1
+    assert embedding_mock.call_args.kwargs['input'] == ['Moria', 'Black Pit']
+
+    generate_embedding('Black  Pit')
+    assert embedding_mock.call_count == 1
+
+    stats = get_embedding_cache_stats()
+    assert stats['hits'] - stats_before['hits'] == 2
+    assert stats['misses'] - stats_before['misses'] == 2
+    assert EmbeddingCacheEntry.objects.filter(hits=1).count() == 1
+
+
+@pytest.mark.django_db
+def test_embedding_cache_eviction(settings, embedding_mock):
+    settings.EMBEDDING_CACHE_MAX_ENTRIES = 2
+    generate_embeddings(['first', 'second'])
+    generate_embedding('first')
+    generate_embedding('third')
+
+    assert EmbeddingCacheEntry.objects.count() == 2
+    generate_embedding('first')
+    assert embedding_mock.call_count == 2
+
+
+@pytest.mark.django_db
+def test_query_embedding_cache(embedding_mock):
+    query_cache = QueryEmbeddingCache(max_entries=1, ttl=60)
+    cache.clear()
+
+    query_cache.get_embedding('Moria')
+    query_cache.get_embedding(' Moria\n')
+    assert query_cache.get_stats() == {
+        'local_hits': 1, 'shared_hits': 0, 'misses': 1, 'evictions': 0, 'hit_rate': 0.5,
+    }
+
+    # evicts Moria locally, but it stays in the shared cache
+    query_cache.get_embedding('Black Pit')
+    query_cache.get_embedding('Moria')
+    stats = query_cache.get_stats()
+    assert (stats['shared_hits'], stats['evictions']) == (1, 2)
+    # counted for all processes
+    assert QueryEmbeddingCache(max_entries=1, ttl=60).get_stats() == stats
+    assert embedding_mock.call_count == 2
+
+
+def test_run_concurrently():
+    in_flight = []
+    max_in_flight = 0
+
+    async def request(i):
+        nonlocal max_in_flight
+        in_flight.append(i)
+        max_in_flight = max(max_in_flight, len(in_flight))
+        await asyncio.sleep(0.01 * (5 - i))
+        in_flight.remove(i)
+        return i
+
+    results = run_concurrently([lambda i=i: request(i) for i in range(5)], concurrency=2)
+
+    assert results == [0, 1, 2, 3, 4]
+    assert max_in_flight == 2
+
+
+@pytest.mark.django_db
+def test_completion_cache(settings, chat_completion_mock):
+    request = {
+        'messages': [{'role': 'user', 'content': 'Where is Moria?'}],
+        'model': 'gpt-3.5-turbo',
+        'temperature': 0,
+        'max_tokens': 100,
+    }
+    response = create_chat_completion(**request)
+    assert create_chat_completion(**request) == response
+    assert chat_completion_mock.call_count == 1
+    assert CompletionCacheEntry.objects.get().hits == 1
+
+    # the bypass asks again and replaces the cached response
+    chat_completion_mock.return_value.choices[0].message.content = 'Under the Misty Mountains'
+    create_chat_completion(use_cache=False, **request)
+    assert chat_completion_mock.call_count == 2
+    assert create_chat_completion(**request).choices[0].message.content == 'Under the Misty Mountains'
+
+    # sampled completions are not cached
+    create_chat_completion(**{**request, 'temperature': 1})
+    assert chat_completion_mock.call_count == 3
+
+    settings.COMPLETION_CACHE_TTL = 0
+    create_chat_completion(**request)
+    assert chat_completion_mock.call_count == 4
+    assert not CompletionCacheEntry.objects.exists()
+
+
+def test_iter_json_array_items():
+    text = '{"other": ["x"], "next": ["Where is \\"Moria\\"?", "Who is Durin?"]}'
+    seen = []
+
+    def pieces():
+        for i in range(0, len(text), 3):
+            yield text[i:i + 3]
+            seen.append(i + 3)
+
+    items = []
+    for item in iter_json_array_items(pieces(), 'next'):
+        items.append((item, seen[-1]))
+
+    assert [item for item, _ in items] == ['Where is "Moria"?', 'Who is Durin?']
+    # the first item is there before the whole text
+    assert items[0][1] < len(text) - len('"Who is Durin?"]}')
+
+
+@pytest.mark.django_db
+def test_stream_chat_completion_cache(chat_completion_mock):
+    request = {
+        'messages': [{'role': 'user', 'content': 'Where is Moria?'}],
+        'model': 'gpt-3.5-turbo',
+        'temperature': 0,
+    }
+    content = chat_completion_mock.return_value.choices[0].message.content
+
+    pieces = list(stream_chat_completion(**request))
+    assert len(pieces) > 1
+    assert ''.join(pieces) == content
+
+    assert list(stream_chat_completion(**request)) == [content]
+    assert create_chat_completion(**request).choices[0].message.content == content
+    assert chat_completion_mock.call_count == 1
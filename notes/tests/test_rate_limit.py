@@ -0,0 +1,75 @@
+from unittest import mock
+
+import openai
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from .. import rate_limit
+from ..openai import run_rate_limited
+
+
+@pytest.mark.django_db
+def test_reserve_queues_requests(settings):
+    settings.OPENAI_INTERACTIVE_SHARE = 0
+    settings.OPENAI_REQUESTS_PER_MINUTE = 2
+    settings.OPENAI_TOKENS_PER_MINUTE = 600
+
+    waits = rate_limit.reserve([('gpt-3.5-turbo', 100), ('gpt-3.5-turbo', 100), ('gpt-3.5-turbo', 100)])
+
+    # the bucket starts full, the third request waits for a request to refill
+    assert waits[:2] == [0, 0]
+    assert waits[2] == pytest.approx(30, abs=0.1)
+    # then for tokens, buckets of other models are independent
+    assert rate_limit.reserve([('gpt-3.5-turbo', 600)])[0] == pytest.approx(60, abs=0.1)
+    assert rate_limit.reserve([('text-embedding-3-large', 10)]) == [0]
+
+
+@pytest.mark.django_db
+def test_reserve_interactive_requests(settings):
+    settings.OPENAI_INTERACTIVE_SHARE = 0.1
+    settings.OPENAI_REQUESTS_PER_MINUTE = 60
+    settings.OPENAI_TOKENS_PER_MINUTE = 0
+
+    # bulk work reserves far ahead, interactive requests don't queue up behind it
+    assert rate_limit.reserve([('text-embedding-3-large', 10)] * 100)[-1] > 30
+    assert rate_limit.reserve([('text-embedding-3-large', 10)] * 6, interactive=True) == [0] * 6
+    assert rate_limit.reserve([('text-embedding-3-large', 10)], interactive=True)[0] == pytest.approx(10, abs=0.1)
+
+    # buckets are created only once
+    with CaptureQueriesContext(connection) as queries:
+        rate_limit.reserve([('text-embedding-3-large', 10)], interactive=True)
+    assert not [query for query in queries if query['sql'].startswith('INSERT')]
+
+
+@pytest.mark.django_db
+def test_pause(settings):
+    settings.OPENAI_TOKENS_PER_MINUTE = 0
+
+    rate_limit.pause('gpt-3.5-turbo', {'x-ratelimit-reset-requests': '1m30s', 'x-ratelimit-reset-tokens': '20ms'})
+
+    assert rate_limit.reserve([('gpt-3.5-turbo', 100)])[0] == pytest.approx(90, abs=0.1)
+    assert rate_limit.reserve([('gpt-3.5-turbo', 100)], interactive=True)[0] == pytest.approx(90, abs=0.1)
+
+
+def test_get_pause_duration():
+    assert rate_limit.get_pause_duration({'retry-after-ms': '250'}) == 0.25
+    assert rate_limit.get_pause_duration({'retry-after': '3'}) == 3
+    assert rate_limit.get_pause_duration({'x-ratelimit-reset-tokens': '6.5s'}) == 6.5
+    assert rate_limit.get_pause_duration({}) == rate_limit.DEFAULT_PAUSE
+
+
+@pytest.mark.django_db
+def test_run_rate_limited_retries_rejected_requests(settings):
+    settings.OPENAI_REQUESTS_PER_MINUTE = 6000
+    response = mock.Mock(status_code=429, headers={'retry-after-ms': '10'})
+    outcomes = [openai.RateLimitError('Rate limit reached', response=response, body=None), 'response']
+
+    async def request():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    assert run_rate_limited([('gpt-3.5-turbo', 10, request)]) == ['response']
+    assert not outcomes
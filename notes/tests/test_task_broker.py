@@ -0,0 +1,91 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django_q.models import OrmQ
+from django_q.signing import SignedPackage
+
+from .. import task_broker
+
+
+@pytest.fixture
+def broker():
+    broker = task_broker.PostgresBroker('test')
+    yield broker
+    broker.close_listener()
+
+
+def claim_in_thread(broker):
+    try:
+        return broker.claim()
+    finally:
+        connection.close()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_enqueue_wakes_listener_on_commit(broker, monkeypatch):
+    monkeypatch.setattr(task_broker, 'LISTEN_TIMEOUT', 0)
+    broker.listen()
+
+    with transaction.atomic():
+        task_id = broker.enqueue('payload')
+        # not visible to workers before the transaction commits
+        assert not broker.wait(0)
+
+    assert broker.wait(1)
+    assert broker.dequeue() == [(task_id, 'payload')]
+    # claimed tasks are locked until acknowledged
+    assert broker.dequeue() is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_claim_skips_locked_tasks(broker):
+    first_id = broker.enqueue('first')
+    second_id = broker.enqueue('second')
+
+    with transaction.atomic():
+        OrmQ.objects.select_for_update().get(id=first_id)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            tasks = executor.submit(claim_in_thread, broker).result()
+
+    assert tasks == [(second_id, 'second')]
+
+
+def task(number):
+    pass
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_task_on_commit():
+    # a rolled back transaction leaves nothing behind
+    with pytest.raises(ZeroDivisionError), transaction.atomic():
+        task_broker.async_task_on_commit(task, 0)
+        1 / 0
+
+    with CaptureQueriesContext(connection) as queries:
+        with transaction.atomic():
+            task_broker.async_task_on_commit(task, 1)
+            task_broker.async_task_on_commit(task, 2, cluster='bulk')
+            with pytest.raises(ZeroDivisionError), transaction.atomic():
+                task_broker.async_task_on_commit(task, 3)
+                1 / 0
+            with transaction.atomic():
+                task_broker.async_task_on_commit(task, 4)
+            # a released savepoint is rolled back with its parent
+            with pytest.raises(ZeroDivisionError), transaction.atomic():
+                with transaction.atomic():
+                    task_broker.async_task_on_commit(task, 6)
+                1 / 0
+            assert not OrmQ.objects.exists()
+
+    assert sorted(
+        (queued.key, SignedPackage.loads(queued.payload)['args'])
+        for queued in OrmQ.objects.all()
+    ) == [('bulk', (2,)), ('default', (1,)), ('default', (4,))]
+    # one insert for the whole transaction
+    assert len([query for query in queries if query['sql'].startswith('INSERT')]) == 1
+
+    # outside of a transaction the task is enqueued right away
+    task_broker.async_task_on_commit(task, 5)
+    assert OrmQ.objects.count() == 4
@@ -0,0 +1,31 @@
+from datetime import timedelta
+
+import pytest
+from django.utils import timezone
+
+from .. import task_queues
+
+
+def test_get_task_queue(settings):
+    settings.TASK_LANES = ['interactive']
+    assert task_queues.get_task_queue(task_queues.INTERACTIVE) == 'interactive'
+    # no cluster for the lane, it goes to the default one
+    assert task_queues.get_task_queue(task_queues.BULK) == 'default'
+
+
+@pytest.mark.django_db
+def test_queue_wait_stats(settings):
+    settings.TASK_LANES = ['interactive', 'bulk']
+    for wait in (1, 3):
+        task_queues.record_queue_wait(
+            sender='django_q',
+            task={'cluster': 'bulk', 'started': timezone.now() - timedelta(seconds=wait)},
+        )
+
+    stats = task_queues.get_queue_wait_stats()
+
+    assert set(stats) == {'interactive', 'default', 'bulk'}
+    assert stats['bulk']['tasks'] == 2
+    assert stats['bulk']['average_wait'] == pytest.approx(2, abs=0.1)
+    assert stats['bulk']['last_wait'] == pytest.approx(3, abs=0.1)
+    assert stats['interactive'] == {'tasks': 0, 'average_wait': None, 'last_wait': None}
@@ -0,0 +1,417 @@
+import json
+from datetime import timedelta
+
+import numpy
+import pytest
+from django.utils import timezone
+
+from .. import tasks
+from ..models import Note, TaskLease
+from ..tasks import (
+    claim_pending_note_embeddings, claim_pending_note_titles, embed_notes, generate_pending_note_embeddings,
+    get_example_notes, get_note_title_messages, update_note_neighbours,
+)
+from .factories import NoteFactory, NoteReferenceFactory
+
+
+@pytest.mark.django_db
+def test_generate_pending_note_embeddings(notebook, sync_tasks, embedding_mock):
+    notes = Note.objects.bulk_create([
+        *(NoteFactory.build(notebook=notebook, content=f'Some content {i}') for i in range(3)),
+        NoteFactory.build(notebook=notebook, content=''),
+        NoteFactory.build(notebook=notebook, content=' \n '),
+        # python splits at unicode whitespace, postgres `\s` does not match it
+        NoteFactory.build(notebook=notebook, content='\xa0\u3000'),
+    ])
+    unicode_blank_note = notes.pop()
+    blank_note = notes.pop()
+    empty_note = notes.pop()
+
+    generate_pending_note_embeddings()
+
+    # notes without words are not pending, the task does not enqueue itself for them
+    assert embedding_mock.call_count == 1
+    assert len(embedding_mock.call_args.kwargs['input']) == 3
+    for note in notes:
+        note.refresh_from_db()
+        assert numpy.allclose(note.embedding, [0.1] * 3072)
+        assert numpy.allclose(note.embedding_half.to_list(), [0.1] * 3072, atol=1e-3)
+    empty_note.refresh_from_db()
+    assert empty_note.embedding is None
+    blank_note.refresh_from_db()
+    assert blank_note.embedding is None
+    unicode_blank_note.refresh_from_db()
+    assert unicode_blank_note.embedding is None
+    assert not Note.objects.with_stale_embedding().exists()
+
+
+@pytest.mark.django_db
+def test_generate_pending_note_embeddings_token_cap(notebook, settings, sync_tasks, embedding_mock):
+    settings.EMBEDDING_BATCH_MAX_TOKENS = 5
+    Note.objects.bulk_create([
+        NoteFactory.build(notebook=notebook, content=f'Some content {i}')
+        for i in range(3)
+    ])
+
+    generate_pending_note_embeddings()
+
+    # one note per request, the task enqueues itself until all notes are done
+    assert embedding_mock.call_count == 3
+    assert all(len(call.kwargs['input']) == 1 for call in embedding_mock.call_args_list)
+
+
+@pytest.mark.django_db
+def test_claim_pending_note_embeddings(notebook, settings, embedding_mock):
+    settings.EMBEDDING_BATCH_SIZE = 2
+    Note.objects.bulk_create([
+        NoteFactory.build(notebook=notebook, content=f'Some content {i}')
+        for i in range(3)
+    ])
+
+    first_batch = claim_pending_note_embeddings()
+    # a concurrent task gets the rest
+    second_batch = claim_pending_note_embeddings()
+    assert len(first_batch) == 2
+    assert len(second_batch) == 1
+    assert not {note.id for note in first_batch} & {note.id for note in second_batch}
+    assert claim_pending_note_embeddings() == []
+
+    embed_notes(second_batch)
+    assert Note.objects.filter(embedding_claimed_until__isnull=True).count() == 1
+
+    # claims of a killed task expire
+    Note.objects.update(embedding_claimed_until=timezone.now() - timedelta(seconds=1))
+    assert {note.id for note in claim_pending_note_embeddings()} == {note.id for note in first_batch}
+
+
+@pytest.mark.django_db
+def test_content_edit_reembeds_note(notebook, sync_tasks, embedding_mock):
+    note = NoteFactory(notebook=notebook, content='Old content')
+    note.refresh_from_db()
+    assert not note.has_stale_embedding
+    embedding_mock.reset_mock()
+
+    note.title = 'New title'
+    note.save()
+    assert embedding_mock.call_count == 0
+
+    note.content = 'New content'
+    note.save(update_fields=['content'])
+    assert embedding_mock.call_count == 1
+    assert embedding_mock.call_args.kwargs['input'] == ['New content']
+    note.refresh_from_db()
+    assert not note.has_stale_embedding
+    assert not Note.objects.with_stale_embedding().exists()
+
+
+@pytest.mark.django_db
+def test_update_note_neighbours(notebook, other_notebook, settings):
+    settings.NOTE_NEIGHBOURS_COUNT = 1
+    first_note, second_note, third_note, fourth_note, _ = notes = [
+        NoteFactory.build(notebook=notebook),
+        NoteFactory.build(notebook=notebook),
+        NoteFactory.build(notebook=notebook),
+        NoteFactory.build(notebook=notebook),
+        NoteFactory.build(notebook=other_notebook),
+    ]
+    for note, embedding in zip(notes, [[1.0, 0.0], [1.0, 0.1], [0.0, 1.0], [0.1, 1.0], [0.0, 1.0]]):
+        note.set_embedding(embedding * 1536)
+        note.embedding_model, note.embedding_dimensions = 'text-embedding-3-large', 3072
+    Note.objects.bulk_create([first_note, second_note, third_note, notes[-1]])
+
+    update_note_neighbours([first_note.id, second_note.id, third_note.id])
+
+    assert list(Note.objects.neighbours_of(first_note)) == [second_note]
+    assert list(Note.objects.neighbours_of(second_note)) == [first_note]
+    assert list(Note.objects.neighbours_of(third_note)) == [second_note]
+
+    # a new note close to the third one takes its place in the neighbour list
+    Note.objects.bulk_create([fourth_note])
+    update_note_neighbours([fourth_note.id])
+
+    assert list(Note.objects.neighbours_of(third_note)) == [fourth_note]
+    assert list(Note.objects.neighbours_of(fourth_note)) == [third_note]
+    assert Note.objects.neighbours_of(third_note).get().distance == pytest.approx(0.005, abs=1e-3)
+
+
+@pytest.mark.django_db
+def test_generate_references_deduplicates(note, monkeypatch, chat_completion_mock):
+    embeddings = {
+        'Moria': [1.0, 0.0, 0.0],
+        'The Moria': [1.0, 0.1, 0.0],
+        'Shire': [0.0, 1.0, 0.0],
+        'Durin': [0.0, 0.0, 1.0],
+    }
+    monkeypatch.setattr(
+        tasks, 'generate_embeddings',
+        lambda texts, backend=None: [embeddings[text] * 1024 for text in texts],
+    )
+    existing_note = NoteFactory.build(
+        notebook=note.notebook,
+        content='The Shire',
+        embedding_model='text-embedding-3-large',
+        embedding_dimensions=3072,
+    )
+    existing_note.set_embedding([0.0, 1.0, 0.1] * 1024)
+    Note.objects.bulk_create([existing_note])
+    chat_completion_mock.return_value.choices[0].message.content = json.dumps({
+        'next': ['Moria', 'The Moria', 'Shire', 'Durin'],
+    })
+
+    tasks.generate_references(note.id)
+
+    assert {reference.target_note.content for reference in note.references.all()} == {'Moria', 'The Shire', 'Durin'}
+    assert Note.objects.count() == 4
+
+
+@pytest.mark.django_db
+def test_generate_references_saves_notes_as_they_arrive(note, monkeypatch, chat_completion_mock):
+    embeddings = {'first question': [1.0, 0.0], 'second question': [0.0, 1.0]}
+    monkeypatch.setattr(
+        tasks, 'generate_embeddings',
+        lambda texts, backend=None: [embeddings[text] * 1536 for text in texts],
+    )
+    saved_contents = []
+    stream_chat_completion = tasks.stream_chat_completion
+
+    def stream_and_watch(**kwargs):
+        for piece in stream_chat_completion(**kwargs):
+            saved_contents.append(set(note.references.values_list('target_note__content', flat=True)))
+            yield piece
+
+    monkeypatch.setattr(tasks, 'stream_chat_completion', stream_and_watch)
+
+    tasks.generate_references(note.id)
+
+    # the first note is saved while the second one is still being generated
+    assert {'first question'} in saved_contents
+    assert set(note.references.values_list('target_note__content', flat=True)) == {'first question', 'second question'}
+    note.refresh_from_db()
+    assert not note.generating_references
+
+
+@pytest.mark.django_db
+def test_generated_notes_are_searchable(note, monkeypatch, chat_completion_mock):
+    embeddings = {'Where is Moria?': [1.0, 0.0], 'Who is Durin?': [0.0, 1.0]}
+    monkeypatch.setattr(
+        tasks, 'generate_embeddings',
+        lambda texts, backend=None: [embeddings[text] * 1536 for text in texts],
+    )
+    chat_completion_mock.return_value.choices[0].message.content = json.dumps({'next': list(embeddings)})
+    tasks.generate_references(note.id)
+
+    notes = Note.objects.filter(notebook=note.notebook)
+    moria_note = notes.lexical_search('Moria').get()
+    assert moria_note.content == 'Where is Moria?'
+
+    chat_completion_mock.return_value.choices[0].message.content = json.dumps({'titles': {'1': 'Khazad-dum'}})
+    tasks.generate_note_titles([moria_note.id])
+    assert list(notes.lexical_search('Khazad')) == [moria_note]
+
+
+@pytest.mark.django_db
+def test_example_notes_are_deterministic(note):
+    for i in range(6):
+        NoteReferenceFactory(note__notebook=note.notebook, note__content=f'Example {i}', target_note=note)
+
+    # prompts repeat, so their completions are served from the cache
+    assert get_note_title_messages([note]) == get_note_title_messages([note])
+    assert list(get_example_notes(note)) == list(get_example_notes(note))
+
+
+@pytest.mark.django_db
+def test_check_reference_uniqueness(note_reference, other_note):
+    duplicate_note = NoteFactory.build(notebook=other_note.notebook)
+    for target_note in (other_note, duplicate_note):
+        target_note.set_embedding([1.0, 0.0] * 1536)
+        target_note.save()
+    duplicate_reference = NoteReferenceFactory(note=note_reference.note, target_note=duplicate_note)
+
+    tasks.check_reference_uniqueness(duplicate_reference.id)
+
+    assert list(note_reference.note.references.all()) == [note_reference]
+
+
+@pytest.mark.django_db
+def test_embed_notes_in_chunks(notebook, settings, monkeypatch):
+    settings.NOTE_CHUNK_TOKENS = 6
+    settings.NOTE_CHUNK_OVERLAP_TOKENS = 2
+    embedded_texts = []
+
+    def generate_embeddings(texts, backend=None):
+        embedded_texts.extend(texts)
+        return [[float(len(text)), 1.0] * 1536 for text in texts]
+
+    monkeypatch.setattr(tasks, 'generate_embeddings', generate_embeddings)
+    note = Note.objects.bulk_create([NoteFactory.build(notebook=notebook, content='one two three four')])[0]
+
+    tasks.embed_notes([note])
+
+    assert embedded_texts == ['one two', 'two three', 'three four']
+    assert list(note.chunks.values_list('content', flat=True)) == embedded_texts
+    note.refresh_from_db()
+    assert not note.has_stale_embedding
+    # mean of the chunk embeddings
+    assert note.embedding[0] / note.embedding[1] == pytest.approx((7 + 9 + 10) / 3)
+
+    embedded_texts.clear()
+    note.content = 'one two three four five six'
+    tasks.embed_notes([note])
+
+    # unchanged chunks are not embedded again
+    assert embedded_texts == ['four five six']
+    assert list(note.chunks.values_list('content', flat=True)) == [
+        'one two',
+        'two three',
+        'three four',
+        'four five six',
+    ]
+
+
+@pytest.mark.django_db
+def test_generate_note_titles_in_batches(note, other_notebook, settings, chat_completion_mock):
+    settings.NOTE_TITLE_BATCH_SIZE = 2
+    note.title = 'Moria'
+    note.save()
+    notes = Note.objects.bulk_create([
+        *(NoteFactory.build(notebook=note.notebook, title='', content=f'Content {i}') for i in range(3)),
+        NoteFactory.build(notebook=other_notebook, title='', content='Other content'),
+    ])
+    for untitled_note in notes[:3]:
+        NoteReferenceFactory(note=note, target_note=untitled_note)
+
+    def create_completion(messages, **kwargs):
+        contents = json.loads(messages[-1]['content'])['notes']
+        response = chat_completion_mock.return_value.model_copy(deep=True)
+        response.choices[0].message.content = json.dumps({'titles': {
+            number: f'Title of {content}' for number, content in contents.items()
+        }})
+        return response
+
+    chat_completion_mock.side_effect = create_completion
+
+    assert tasks.generate_note_titles([untitled_note.id for untitled_note in notes]) == 4
+
+    # notes of different notebooks are never batched together
+    assert chat_completion_mock.call_count == 3
+    batches = [
+        set(json.loads(call.kwargs['messages'][-1]['content'])['notes'].values())
+        for call in chat_completion_mock.call_args_list
+    ]
+    assert {'Other content'} in batches
+    messages = next(
+        call.kwargs['messages']
+        for call in chat_completion_mock.call_args_list
+        if len(call.kwargs['messages']) > 2
+    )
+    # the examples are shared by the whole batch
+    assert json.loads(messages[1]['content']) == {'notes': {'1': note.content}}
+    assert json.loads(messages[2]['content']) == {'titles': {'1': 'Moria'}}
+    assert sorted(Note.objects.filter(id__in=[n.id for n in notes]).values_list('title', flat=True)) == [
+        'Title of Content 0', 'Title of Content 1', 'Title of Content 2', 'Title of Other content',
+    ]
+
+
+@pytest.mark.django_db
+def test_generate_note_titles_rejects_mismatched_batch(notebook, chat_completion_mock):
+    notes = Note.objects.bulk_create([
+        NoteFactory.build(notebook=notebook, title='', content=f'Content {i}')
+        for i in range(2)
+    ])
+    # one title for two notes, it is unclear which one it belongs to
+    chat_completion_mock.return_value.choices[0].message.content = json.dumps({'titles': {'1': 'Title'}})
+
+    assert tasks.generate_note_titles([note.id for note in notes]) == 0
+    assert set(Note.objects.values_list('title', flat=True)) == {''}
+
+
+@pytest.mark.django_db
+def test_claim_pending_note_titles(notebook, settings, chat_completion_mock):
+    settings.NOTE_TITLE_BATCH_SIZE = 2
+    settings.OPENAI_CONCURRENCY = 1
+    notes = Note.objects.bulk_create([
+        *(NoteFactory.build(notebook=notebook, title='', content=f'Content {i}') for i in range(3)),
+        NoteFactory.build(notebook=notebook, title='', content='\xa0\n'),
+    ])
+
+    first_batch = claim_pending_note_titles()
+    # a concurrent task gets the rest, notes without words are never titled
+    second_batch = claim_pending_note_titles()
+    assert first_batch == sorted(note.id for note in notes[:3])[:2]
+    assert len(second_batch) == 1
+    assert claim_pending_note_titles() == []
+
+    # the model skips the note, it stays claimed so it doesn't hold back other notes
+    chat_completion_mock.return_value.choices[0].message.content = json.dumps({'titles': {'1': ''}})
+    assert tasks.generate_note_titles(second_batch) == 0
+    assert Note.objects.get(id=second_batch[0]).title_claimed_until is not None
+
+    # claims of a killed task expire
+    Note.objects.update(title_claimed_until=timezone.now() - timedelta(seconds=1))
+    assert len(claim_pending_note_titles()) == 2
+
+
+@pytest.mark.django_db
+def test_async_task_once(monkeypatch):
+    enqueued = []
+    monkeypatch.setattr(tasks, 'async_task_on_commit', lambda *args, **kwargs: enqueued.append((args, kwargs)))
+    calls = []
+
+    def task(number):
+        calls.append(number)
+
+    assert tasks.async_task_once(task, key='some-task', number=1)
+    # queued, so a task with the same key is not enqueued again
+    assert not tasks.async_task_once(task, key='some-task', number=2)
+    assert tasks.async_task_once(task, key='other-task', number=3)
+    assert len(enqueued) == 2
+
+    (_, lease_key, func), kwargs = enqueued[0]
+    tasks.run_task_once(lease_key, func, number=kwargs['number'])
+    assert calls == [1]
+    # finished, the key is released
+    assert tasks.async_task_once(task, key='some-task', number=4)
+
+
+@pytest.mark.django_db
+def test_schedule_generate_references_once(note, settings, monkeypatch):
+    settings.TASK_LANES = ['interactive']
+    enqueued = []
+    monkeypatch.setattr(tasks, 'async_task_on_commit', lambda *args, **kwargs: enqueued.append(kwargs))
+
+    assert note.schedule_generate_references()
+    assert not note.schedule_generate_references(use_cache=False)
+
+    assert len(enqueued) == 1
+    assert enqueued[0]['note_id'] == note.id
+    assert enqueued[0]['cluster'] == 'interactive'
+    assert enqueued[0]['cached_after'] is None
+
+    # the key is held by a task of another process, the flag is left to that task
+    Note.objects.filter(id=note.id).update(generating_references=False)
+    assert not note.schedule_generate_references()
+    note.refresh_from_db()
+    assert not note.generating_references
+
+    # finished, the key is released
+    TaskLease.objects.all().delete()
+    assert note.schedule_generate_references(use_cache=False)
+    assert enqueued[1]['cached_after'] is not None
+    note.refresh_from_db()
+    assert note.generating_references
+
+
+@pytest.mark.django_db
+def test_generate_references_retry_reads_first_response(note, chat_completion_mock, embedding_mock):
+    chat_completion_mock.return_value.choices[0].message.content = json.dumps({'next': ['Where is Moria?']})
+    tasks.generate_references(note.id)
+    assert chat_completion_mock.call_count == 1
+
+    # asked again, the cached response is older
+    cached_after = timezone.now()
+    tasks.generate_references(note.id, cached_after=cached_after)
+    assert chat_completion_mock.call_count == 2
+
+    # a retry of the same task reads the response of its first run
+    tasks.generate_references(note.id, cached_after=cached_after)
+    assert chat_completion_mock.call_count == 2
@@ -0,0 +1,66 @@
+import pytest
+
+from ..models import Note
+from ..tasks import embed_notes
+from ..vector_index import NotebookVectorIndex, update_vector_indexes
+from .factories import NoteFactory
+
+
+@pytest.fixture
+def numpy_backend(settings, tmp_path):
+    settings.EMBEDDING_SEARCH_BACKEND = 'numpy'
+    settings.EMBEDDING_INDEX_DIR = str(tmp_path)
+
+
+@pytest.mark.django_db
+def test_numpy_embedding_search(notebook, other_notebook, embedding_mock, numpy_backend):
+    # query embedding is [0.1] * 3072
+    close_note = NoteFactory(notebook=notebook, embedding=[0.1, 0.09] * 1536)
+    far_note = NoteFactory(notebook=notebook, embedding=[0.1, -0.1] * 1536)
+    other_notebook_note = NoteFactory(notebook=other_notebook, embedding=[0.1] * 3072)
+
+    notes = Note.objects.filter(notebook=notebook).embedding_search('query')
+    assert list(notes) == [close_note, far_note]
+    assert notes[1].distance == pytest.approx(1, abs=1e-6)
+
+    # index is updated in place when embeddings are written
+    new_note = NoteFactory(notebook=notebook, content='Moria')
+    embed_notes([new_note])
+    ids, _ = NotebookVectorIndex(notebook.id).load()
+    assert len(ids) == 3
+    notes = Note.objects.filter(notebook=notebook).embedding_search('query')
+    assert list(notes) == [new_note, close_note, far_note]
+
+    notes = Note.objects.all().embedding_search('query', rerank_candidates=1)
+    assert set(notes) == {new_note, other_notebook_note}
+
+
+@pytest.mark.django_db
+def test_notebook_vector_index_batch_search(notebook, numpy_backend):
+    first_note = NoteFactory(notebook=notebook, embedding=[1.0, 0.0] * 1536)
+    second_note = NoteFactory(notebook=notebook, embedding=[0.0, 1.0] * 1536)
+
+    results = NotebookVectorIndex(notebook.id).search([[0.0, 2.0] * 1536, [1.0, 0.5] * 1536], k=1)
+    assert [[note_id for note_id, _ in result] for result in results] == [[second_note.id], [first_note.id]]
+
+
+@pytest.mark.django_db
+def test_notebook_vector_index_update_in_place(notebook, numpy_backend):
+    note = NoteFactory(notebook=notebook, embedding=[1.0, 0.0] * 1536)
+    NoteFactory(notebook=notebook, embedding=[0.0, 1.0] * 1536)
+    index = NotebookVectorIndex(notebook.id)
+    index.build()
+    stat = index.embeddings_path.stat()
+
+    note.embedding = [0.0, 1.0] * 1536
+    update_vector_indexes([note])
+    assert (index.embeddings_path.stat().st_ino, index.embeddings_path.stat().st_size) == (stat.st_ino, stat.st_size)
+    [results] = index.search([[0.0, 1.0] * 1536], k=2)
+    assert all(distance == pytest.approx(0, abs=1e-5) for _, distance in results)
+
+    new_note = NoteFactory(notebook=notebook, embedding=[1.0, 0.0] * 1536)
+    update_vector_indexes([new_note])
+    assert index.embeddings_path.stat().st_ino == stat.st_ino
+    ids, embeddings = index.load()
+    assert len(ids) == len(embeddings) == 3
+    assert index.search([[1.0, 0.0] * 1536], k=1)[0][0][0] == new_note.id
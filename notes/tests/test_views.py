@@ -55,7 +55,7 @@ def test_answer_get_suggestions(user_client, note_reference, notebook_user_permi
 
 @pytest.mark.django_db
 @pytest.mark.parametrize('other_note', [{'title': 'Another note'}], indirect=True)
-def test_answer_suggestions_some(user_client, note_reference, other_note, notebook_user_permission):
+def test_answer_suggestions_some(user_client, note_reference, other_note, notebook_user_permission, embedding_mock):
     response = user_client.get(reverse(
         'notes:answer:get_suggestions',
         kwargs={'note_reference_id': note_reference.id},
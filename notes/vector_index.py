@@ -0,0 +1,196 @@
+"""
+Exact semantic search in numpy, an alternative to pgvector indexes for notebooks of modest size.
+
+Every notebook has a pair of memory mapped files: note ids and a matrix of L2 normalized embeddings,
+both plain rows without a header, so the number of rows follows from the file size.
+Pages of the files are shared by all processes on the machine through the OS page cache.
+Rows are only ever appended or overwritten in place, so a reader that catches the files mid update
+still sees matching ids and embeddings once both are truncated to the shorter one.
+"""
+import os
+import threading
+import uuid
+from pathlib import Path
+
+import numpy
+from django.conf import settings
+from django.db import transaction
+
+from .models import Note, Notebook
+from .openai import EMBEDDING_DIMENSIONS
+
+
+class NotebookVectorIndex:
+    def __init__(self, notebook_id):
+        self.notebook_id = notebook_id
+        directory = Path(settings.EMBEDDING_INDEX_DIR)
+        self.ids_path = directory / f'{notebook_id}.ids'
+        self.embeddings_path = directory / f'{notebook_id}.embeddings'
+
+    def exists(self):
+        return self.ids_path.exists() and self.embeddings_path.exists()
+
+    def load(self, mode='r'):
+        """
+        Mapped ids and embeddings, with `mode='r+'` embeddings can be overwritten in place.
+        """
+        ids = map_rows(self.ids_path, numpy.uint8, ID_ROW_BYTES)
+        embeddings = map_rows(self.embeddings_path, numpy.float32, EMBEDDING_DIMENSIONS, mode)
+        size = min(len(ids), len(embeddings))
+        return ids[:size], embeddings[:size]
+
+    def search(self, query_embeddings, k):
+        """
+        Top `k` notes for each of the query embeddings, as lists of (note id, cosine distance) pairs.
+        """
+        ids, embeddings = get_mapped_index(self)
+        queries = normalize(numpy.asarray(query_embeddings, dtype=numpy.float32))
+        k = min(k, len(ids))
+        if not k:
+            return [[] for _ in queries]
+        similarities = embeddings @ queries.T
+        top = numpy.argpartition(-similarities, k - 1, axis=0)[:k]
+        results = []
+        for column, rows in enumerate(top.T):
+            rows = rows[numpy.argsort(-similarities[rows, column])]
+            results.append([
+                (uuid.UUID(bytes=ids[row].tobytes()), 1 - float(similarities[row, column]))
+                for row in rows
+            ])
+        return results
+
+    def build(self):
+        """
+        Write the index from scratch.
+        """
+        notes = Note.objects.with_embeddings().filter(
+            notebook_id=self.notebook_id,
+            embedding__isnull=False,
+        ).order_by('id').values_list('id', 'embedding')
+        ids = []
+        embeddings = []
+        for note_id, embedding in notes.iterator():
+            ids.append(note_id.bytes)
+            embeddings.append(embedding)
+        self.write(
+            ids_to_array(ids),
+            normalize(numpy.array(embeddings, dtype=numpy.float32).reshape(len(ids), EMBEDDING_DIMENSIONS)),
+        )
+
+    def update(self, notes):
+        """
+        Overwrite rows of already indexed notes in place and append the rest.
+        Rows of deleted notes are left in place, search results go through the database anyway.
+        """
+        if not self.exists():
+            self.build()
+            return
+        # drop rows of an interrupted append, before the files are mapped
+        size = min(count_rows(self.ids_path, ID_ROW_BYTES), count_rows(self.embeddings_path, EMBEDDING_ROW_BYTES))
+        os.truncate(self.ids_path, size * ID_ROW_BYTES)
+        os.truncate(self.embeddings_path, size * EMBEDDING_ROW_BYTES)
+        ids, embeddings = self.load(mode='r+')
+        rows = {note_id.tobytes(): row for row, note_id in enumerate(ids)}
+        new_ids = []
+        new_embeddings = []
+        for note in notes:
+            embedding = normalize(numpy.asarray(note.embedding, dtype=numpy.float32))
+            row = rows.get(note.id.bytes)
+            if row is None:
+                new_ids.append(note.id.bytes)
+                new_embeddings.append(embedding)
+            else:
+                embeddings[row] = embedding
+        if isinstance(embeddings, numpy.memmap):
+            embeddings.flush()
+        if new_ids:
+            # ids first, a reader may see more ids than embeddings but never unknown embeddings
+            with open(self.ids_path, 'ab') as f:
+                f.write(ids_to_array(new_ids).tobytes())
+            with open(self.embeddings_path, 'ab') as f:
+                f.write(numpy.array(new_embeddings, dtype=numpy.float32).tobytes())
+
+    def write(self, ids, embeddings):
+        self.embeddings_path.parent.mkdir(parents=True, exist_ok=True)
+        for path, array in ((self.ids_path, ids), (self.embeddings_path, embeddings)):
+            tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+            with open(tmp_path, 'wb') as f:
+                f.write(numpy.ascontiguousarray(array).tobytes())
+            os.replace(tmp_path, path)
+
+
+# one row of 16 bytes per uuid
+ID_ROW_BYTES = 16
+EMBEDDING_ROW_BYTES = EMBEDDING_DIMENSIONS * 4
+
+
+def count_rows(path, row_bytes):
+    return path.stat().st_size // row_bytes
+
+
+def map_rows(path, dtype, width, mode='r'):
+    rows = count_rows(path, numpy.dtype(dtype).itemsize * width)
+    if not rows:
+        # empty files can't be mapped
+        return numpy.empty((0, width), dtype=dtype)
+    return numpy.memmap(path, dtype=dtype, mode=mode, shape=(rows, width))
+
+
+def ids_to_array(ids):
+    return numpy.frombuffer(b''.join(ids), dtype=numpy.uint8).reshape(len(ids), ID_ROW_BYTES)
+
+
+def normalize(embeddings):
+    norms = numpy.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return (embeddings / numpy.where(norms == 0, 1, norms)).astype(numpy.float32)
+
+
+# per process cache of mapped files, keyed by notebook and checked against the identity and size of the files,
+# rows overwritten in place show up in the mapping by themselves
+_mapped_indexes = {}
+_mapped_indexes_lock = threading.Lock()
+
+
+def get_mapped_index(index):
+    if not index.exists():
+        update_notebook_vector_index(index.notebook_id)
+    version = tuple(
+        (stat.st_ino, stat.st_size)
+        for stat in (index.ids_path.stat(), index.embeddings_path.stat())
+    )
+    with _mapped_indexes_lock:
+        cached = _mapped_indexes.get(index.notebook_id)
+        if cached is None or cached[0] != version:
+            cached = (version, *index.load())
+            _mapped_indexes[index.notebook_id] = cached
+    return cached[1:]
+
+
+def update_notebook_vector_index(notebook_id, notes=None):
+    """
+    Add embeddings of the notes to the index of the notebook, or build the whole index if `notes` is None.
+    """
+    index = NotebookVectorIndex(notebook_id)
+    # serialize writers of the same notebook index
+    with transaction.atomic():
+        Notebook.objects.select_for_update().get(id=notebook_id)
+        if notes is None:
+            index.build()
+        else:
+            index.update(notes)
+
+
+def update_vector_indexes(notes):
+    """
+    Called whenever note embeddings are written.
+    """
+    if settings.EMBEDDING_SEARCH_BACKEND != 'numpy':
+        return
+    notes_by_notebook = {}
+    for note in notes:
+        # notes without words have no embedding
+        if note.embedding is None:
+            continue
+        notes_by_notebook.setdefault(note.notebook_id, []).append(note)
+    for notebook_id, notebook_notes in notes_by_notebook.items():
+        update_notebook_vector_index(notebook_id, notebook_notes)
@@ -134,7 +134,7 @@ def get_suggestions(request, note_reference_id):
     text = request.GET.get('answer', '')
     suggested_notes = Note.objects.filter(
       notebook_id=note_reference.notebook_id,
-    ).autocomplete_search(text)
+    ).hybrid_search(text)
     template_block = get_template_block(template, 'suggested_notes')
     return TemplateResponse(request, template_block, {
         'note_reference': note_reference,
@@ -4,6 +4,7 @@ from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 from django.template.response import TemplateResponse
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from djsfc import Router, get_template_block, parse_template
 
@@ -56,7 +57,13 @@ template_str = '''\
 
     <section>
       <h2>Further reading</h2>
-      {% for note_reference in note.references.all %}
+      {% block note_references %}
+      {% if swap_oob %}
+        <div hx-swap-oob="beforeend:#note-references-{{ note.id }}">
+      {% else %}
+        <div id="note-references-{{ note.id }}">
+      {% endif %}
+      {% for note_reference in note_references %}
         {% block note_reference %}
           {% if editing %}
             <form hx-post="{% url ':note_reference_save' note_reference.id %}" hx-target="this" hx-swap="outerHTML">
@@ -97,6 +104,8 @@ template_str = '''\
           {% endif %}
         {% endblock %}
       {% endfor %}
+      </div>
+      {% endblock %}
 
       {% if adding_reference %}
         {% block new_note_reference %}
@@ -157,6 +166,17 @@ template_str = '''\
       </p>
 
     </section>
+
+    {% if related_notes %}
+      <section>
+        <h2>Related notes</h2>
+        <ul>
+          {% for related_note in related_notes %}
+            <li><a href="{% url 'notes:note:root' related_note.id %}">{{ related_note }}</a></li>
+          {% endfor %}
+        </ul>
+      </section>
+    {% endif %}
   </main>
 {% endblock %}
 '''
@@ -166,6 +186,7 @@ note_reference_block = get_template_block(template, 'note_reference')
 new_note_reference_block = get_template_block(template, 'new_note_reference')
 new_note_block = get_template_block(template, 'new_note')
 generate_references_button_template = get_template_block(template, 'generate_references_button')
+note_references_template = get_template_block(template, 'note_references')
 
 router.route_all('select/', note_select.router)
 
@@ -177,7 +198,9 @@ def root(request, note_id):
       'note': note,
       'editing': False,
       'adding_reference': False,
+      'note_references': note.references.all(),
       'now': timezone.now(),
+      'related_notes': Note.objects.neighbours_of(note),
     })
 
 
@@ -289,16 +312,28 @@ def new_note_save(request, note_id):
 @router.route('GET', '<uuid:note_id>/generate-references-button')
 def generate_references_button(request, note_id):
     note = get_note(request, note_id)
-    return TemplateResponse(request, generate_references_button_template, {
+    now = timezone.now()
+    # references are saved one by one while generating, every poll of the button appends the new ones,
+    # the rest is left alone as they may be open for editing
+    since = parse_datetime(request.GET.get('now', ''))
+    new_references = note.references.filter(created_at__gt=since) if since else note.references.none()
+    context = {
         'note': note,
-        'now': timezone.now(),
-    })
+        'note_references': new_references,
+        'now': now,
+        'swap_oob': True,
+    }
+    response = generate_references_button_template.render(context, request)
+    if new_references:
+        response += note_references_template.render(context, request)
+    return HttpResponse(response)
 
 
 @router.route('POST', '<uuid:note_id>/trigger-auto-qa-generation')
 def trigger_auto_qa_generation(request, note_id):
     note = get_note(request, note_id)
-    note.schedule_generate_references()
+    # explicit request for new questions, don't serve the previous ones from the cache
+    note.schedule_generate_references(use_cache=False)
     return TemplateResponse(request, generate_references_button_template, {
         'note': note,
         'now': timezone.now(),
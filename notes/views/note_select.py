@@ -140,7 +140,8 @@ def select_dialog_empty(request, field_name, notebook_id):
 def note_search(request, field_name, notebook_id):
     notebook = get_notebook(request, notebook_id)
     query = request.GET.get('q')
-    notes = notebook.notes.autocomplete_search(query)[:10]
+    # runs as the user types, so no query embeddings
+    notes = notebook.notes.hybrid_search(query, fuzzy=True, semantic=False)[:10]
     return TemplateResponse(request, search_results_template, {
         'field_name': field_name,
         'notebook_id': notebook.id,
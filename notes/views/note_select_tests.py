@@ -1,3 +1,5 @@
+from unittest import mock
+
 import pytest
 from django.urls import reverse
 
@@ -13,3 +15,18 @@ def test_select_dialog(user_client, user, note, notebook_user_permission):
     )
     response = user_client.get(url)
     assert response.status_code == 200
+
+
+@pytest.mark.django_db
+@pytest.mark.urls(router.urls)
+def test_note_search(user_client, user, note, notebook_user_permission, monkeypatch):
+    generate_query_embedding = mock.Mock()
+    monkeypatch.setattr('notes.models.generate_query_embedding', generate_query_embedding)
+    url = reverse(
+        'note_search',
+        kwargs={'field_name': 'field_name', 'notebook_id': note.notebook_id},
+    )
+    response = user_client.get(url, {'q': note.title[:3]})
+    assert response.status_code == 200
+    assert list(response.context['notes']) == [note]
+    assert not generate_query_embedding.called
@@ -1,5 +1,40 @@
 import pytest
 from django.urls import reverse
+from django.utils import timezone
+
+from ..models import NoteNeighbour
+from ..tests.factories import NoteFactory, ReferenceFactory
+
+
+@pytest.mark.django_db
+def test_note_related_notes(user_client, note, notebook_user_permission):
+    related_note = NoteFactory(notebook=note.notebook)
+    NoteNeighbour.objects.create(note=note, neighbour=related_note, distance=0.1)
+    response = user_client.get(reverse('notes:note:root', kwargs={'note_id': note.id}))
+    assert response.status_code == 200
+    assert list(response.context_data['related_notes']) == [related_note]
+    assert related_note.get_absolute_url() in response.content.decode()
+
+
+@pytest.mark.django_db
+def test_generate_references_button_appends_new_references(user_client, note_reference, notebook_user_permission):
+    url = reverse('notes:note:generate_references_button', kwargs={'note_id': note_reference.note.id})
+    since = timezone.now()
+    new_reference = ReferenceFactory(
+        note=note_reference.note,
+        target_note=NoteFactory(notebook=note_reference.note.notebook),
+    )
+
+    response = user_client.get(url, {'now': since.isoformat()})
+    assert response.status_code == 200
+    content = response.content.decode()
+    assert f'hx-swap-oob="beforeend:#note-references-{note_reference.note.id}"' in content
+    assert new_reference.target_note.get_absolute_url() in content
+    # references shown before are left alone, they may be open for editing
+    assert note_reference.target_note.get_absolute_url() not in content
+
+    response = user_client.get(url, {'now': timezone.now().isoformat()})
+    assert 'hx-swap-oob' not in response.content.decode()
 
 
 @pytest.mark.django_db